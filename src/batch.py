@@ -0,0 +1,33 @@
+import argparse
+import asyncio
+import json
+import os
+
+from utils import BeatToStory, ResponseCache, run_batch
+
+
+def main():
+    """
+    Offline batch runner, e.g. `python batch.py requests.jsonl results.jsonl --concurrency 8`.
+    Re-running with the same output file resumes where the last run stopped.
+    """
+    parser = argparse.ArgumentParser(
+        description="Generate stories for every BeatConfig/BeatMetadataConfig record in a JSONL file."
+    )
+    parser.add_argument("input", help="JSONL file of request payloads")
+    parser.add_argument("output", help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    template = BeatToStory(
+        response_cache=ResponseCache(path=os.environ.get("PROMPT2PROSE_CACHE_PATH"))
+    )
+    template.setup_pipeline()
+    counts = asyncio.run(
+        run_batch(template, args.input, args.output, concurrency=args.concurrency)
+    )
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import argparse
+import asyncio
+import json
+import sys
+
+from utils import (
+    BENCHMARK_BEAT_COUNTS,
+    BENCHMARK_VARIANTS,
+    BeatToStory,
+    FakeBackend,
+    compare_to_baseline,
+    load_report,
+    parse_agent_models,
+    run_benchmark,
+)
+
+
+def main():
+    """
+    Offline pipeline benchmark against a seeded FakeBackend, e.g.
+    `python benchmark.py --output baseline.json` once, then after a change
+    `python benchmark.py --baseline baseline.json`, which exits 1 on a regression.
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark BeatToStory.pipe() across beat counts and metadata variants."
+    )
+    parser.add_argument("--beats", type=int, nargs="+", default=BENCHMARK_BEAT_COUNTS)
+    parser.add_argument(
+        "--variants",
+        nargs="+",
+        choices=list(BENCHMARK_VARIANTS),
+        default=list(BENCHMARK_VARIANTS),
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=20.0)
+    parser.add_argument("--latency-sigma", type=float, default=0.3)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--story-rejection-rate", type=float, default=0.1)
+    parser.add_argument("--length-failure-rate", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--speculative-candidates", type=int, default=1)
+    parser.add_argument(
+        "--retry-mode", choices=["feedback", "resample"], default="feedback"
+    )
+    parser.add_argument(
+        "--context-mode", choices=["serial", "parallel"], default="serial"
+    )
+    parser.add_argument(
+        "--context-encoding", choices=["raw", "compact", "delta"], default="compact"
+    )
+    parser.add_argument("--edit-mode", choices=["full", "windowed"], default="full")
+    parser.add_argument(
+        "--sequential-rewrite",
+        action="store_true",
+        help="Rewrite genre and style in two calls instead of one fused call",
+    )
+    parser.add_argument(
+        "--prefilter-accept-above",
+        type=float,
+        help="Accept passages this similar to their beats without the StoryAgent call",
+    )
+    parser.add_argument(
+        "--agent-models",
+        help='Per-agent model routes, e.g. "story=fast,context=fast,prose=gpt-4o"',
+    )
+    parser.add_argument("--output", help="Write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report to compare against")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed slowdown/increase per metric before it counts as a regression",
+    )
+    args = parser.parse_args()
+
+    backend = FakeBackend(
+        latency_ms=args.latency_ms,
+        latency_sigma=args.latency_sigma,
+        error_rate=args.error_rate,
+        rejection_rate=args.story_rejection_rate,
+        length_failure_rate=args.length_failure_rate,
+        seed=args.seed,
+    )
+    template = BeatToStory(
+        speculative_candidates=args.speculative_candidates,
+        retry_mode=args.retry_mode,
+        context_mode=args.context_mode,
+        context_encoding=args.context_encoding,
+        edit_mode=args.edit_mode,
+        fused_rewrite=not args.sequential_rewrite,
+        agent_models=parse_agent_models(args.agent_models),
+        prefilter_accept_above=args.prefilter_accept_above,
+    )
+    template.setup_pipeline()
+    report = asyncio.run(
+        run_benchmark(template, backend, args.beats, args.variants, args.repeat)
+    )
+
+    for result in report["results"]:
+        print(
+            f"{result['name']:<24} {result['wall_seconds']:8.2f}s "
+            f"{result['llm_calls']:7.0f} calls  ${result['cost']:.5f}  "
+            f"{result['attempts_per_beat']:.2f} attempts/beat"
+            + (
+                f"  {result['rewrite_seconds']:.3f}s of "
+                f"{result['passage_seconds']:.3f}s/passage rewriting"
+                if result["rewrite_seconds"]
+                else ""
+            )
+        )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        regressions = compare_to_baseline(
+            report, load_report(args.baseline), args.tolerance
+        )
+        if regressions:
+            print(f"\nREGRESSIONS against {args.baseline}:", file=sys.stderr)
+            for regression in regressions:
+                print(f"  {regression}", file=sys.stderr)
+            sys.exit(1)
+        print(f"\nNo regressions against {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,54 @@
+import asyncio
+import json
+import os
+from contextlib import asynccontextmanager
 from datetime import datetime
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
 
 from utils import (
     BeatConfig,
     BeatMetadataConfig,
     BeatToStory,
-    MetadataAgent,
+    BudgetExceededError,
+    CheckpointStore,
+    IdempotencyConflictError,
+    JobQueue,
+    JobResponse,
+    JobStore,
+    QueueFullError,
+    RequestCoalescer,
+    ResponseCache,
+    RunStateStore,
     StoryResponse,
-    StyleGenreAgent,
+    iter_batch_results,
+    metrics,
+    parse_agent_models,
+    rate_limiter,
 )
 
-app = FastAPI()
+
+async def _purge_checkpoints():
+    """Drop checkpoints of abandoned and long-finished runs, then again every hour."""
+    while True:
+        checkpoint_store.purge(abandoned_after_seconds=CHECKPOINT_MAX_AGE_SECONDS)
+        await asyncio.sleep(3600)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    job_store.purge_finished(max_age_seconds=7 * 24 * 3600)
+    state_store.purge(max_age_seconds=7 * 24 * 3600)
+    checkpoint_gc = asyncio.create_task(_purge_checkpoints())
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    checkpoint_gc.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -22,7 +57,61 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-beatbot = BeatToStory()
+# Deterministic agents share this cache; set PROMPT2PROSE_CACHE_PATH to persist it.
+response_cache = ResponseCache(path=os.environ.get("PROMPT2PROSE_CACHE_PATH"))
+
+# Contexts and passages of earlier requests; a resubmitted story with a few edited
+# beats only regenerates from the first edit. Set PROMPT2PROSE_STATE_DB to persist it.
+state_store = RunStateStore(path=os.environ.get("PROMPT2PROSE_STATE_DB", ":memory:"))
+
+# Identical story requests in flight share one pipeline run, and repeats within
+# PROMPT2PROSE_COALESCE_WINDOW_SECONDS of it finishing get its response.
+coalescer = RequestCoalescer(
+    window_seconds=float(os.environ.get("PROMPT2PROSE_COALESCE_WINDOW_SECONDS", 30))
+)
+
+# Stage checkpoints of requests sent with an idempotency_key; a retry with the same key
+# resumes from the last one. Checkpoints untouched for PROMPT2PROSE_CHECKPOINT_MAX_AGE_SECONDS
+# (default one day) are garbage collected.
+checkpoint_store = CheckpointStore(
+    path=os.environ.get("PROMPT2PROSE_CHECKPOINT_DB", "prompt2prose_checkpoints.sqlite")
+)
+CHECKPOINT_MAX_AGE_SECONDS = float(
+    os.environ.get("PROMPT2PROSE_CHECKPOINT_MAX_AGE_SECONDS", 24 * 3600)
+)
+
+# Shared template: holds the agent pool, every request gets its own run via new_run().
+beatbot = BeatToStory(
+    response_cache=response_cache,
+    state_store=state_store,
+    checkpoint_store=checkpoint_store,
+    retry_mode=os.environ.get("PROMPT2PROSE_RETRY_MODE", "feedback"),
+    stream_prose=os.environ.get("PROMPT2PROSE_STREAM_PROSE", "1") != "0",
+    prose_overrun_words=int(os.environ.get("PROMPT2PROSE_PROSE_OVERRUN_WORDS", 20)),
+    prose_overrun_action=os.environ.get("PROMPT2PROSE_PROSE_OVERRUN_ACTION", "trim"),
+    speculative_candidates=int(
+        os.environ.get("PROMPT2PROSE_SPECULATIVE_CANDIDATES", 1)
+    ),
+    max_candidates_per_beat=os.environ.get("PROMPT2PROSE_MAX_CANDIDATES_PER_BEAT"),
+    context_mode=os.environ.get("PROMPT2PROSE_CONTEXT_MODE", "serial"),
+    context_encoding=os.environ.get("PROMPT2PROSE_CONTEXT_ENCODING", "compact"),
+    edit_mode=os.environ.get("PROMPT2PROSE_EDIT_MODE", "full"),
+    edit_window_passages=int(os.environ.get("PROMPT2PROSE_EDIT_WINDOW_PASSAGES", 3)),
+    incremental_edit=os.environ.get("PROMPT2PROSE_INCREMENTAL_EDIT", "1") != "0",
+    max_cost_per_run=os.environ.get("PROMPT2PROSE_MAX_COST_PER_RUN"),
+    max_seconds_per_run=os.environ.get("PROMPT2PROSE_MAX_SECONDS_PER_RUN"),
+    prefilter_reject_below=float(
+        os.environ.get("PROMPT2PROSE_PREFILTER_REJECT_BELOW", 0.02)
+    ),
+    prefilter_accept_above=os.environ.get("PROMPT2PROSE_PREFILTER_ACCEPT_ABOVE"),
+    prefilter_shadow_rate=float(
+        os.environ.get("PROMPT2PROSE_PREFILTER_SHADOW_RATE", 0.0)
+    ),
+    fused_rewrite=os.environ.get("PROMPT2PROSE_FUSED_REWRITE", "1") != "0",
+    max_style_agents=int(os.environ.get("PROMPT2PROSE_MAX_STYLE_AGENTS", 32)),
+    # e.g. "story=fast,context=fast,prose=gpt-4o,flow=gpt-4o"
+    agent_models=parse_agent_models(os.environ.get("PROMPT2PROSE_AGENT_MODELS")),
+)
 beatbot.setup_pipeline()
 
 
@@ -39,6 +128,16 @@ async def root():
         GET /beat_to_story/ - Returns the agentic pipeline for beat to story generation, including agents, llms, and prompts.
         POST /beat_to_story/generate. - Returns a json output with: a multi-agentic workflow story generated from a list of user provided beats, cost per agent in pipeline, story word count, and generation time.
         POST /metadata_to_story/generate/ - Returns a story generated from a list of user provided metadata.
+        Both generate endpoints take optional max_cost (dollars) and max_seconds caps; optional stages are dropped to stay within them.
+        They also take an optional idempotency_key: a retry with the same key resumes from the last finished stage instead of starting over.
+        POST /jobs/beat_to_story/ and /jobs/metadata_to_story/ - Queue a generation and return a job id right away (429 when the queue is full).
+        POST /batch/generate/ - Takes JSONL story requests and streams back one JSONL result per request as each finishes.
+        GET /jobs/{job_id} - Returns job status, per-stage progress and, once done, the story response.
+        POST /beat_to_story/generate/stream/ and /metadata_to_story/generate/stream/ - Same pipelines as server-sent events: context, each passage, the edited story token by token, then the final response.
+        GET /cache/stats/ - Returns hit/miss counters of the LLM response cache.
+        GET /coalesce/stats/ - Returns how many generate requests ran a pipeline and how many shared one with an identical request.
+        GET /llm/stats/ - Returns rate limiter metrics: queue wait times, retries, 429s and the current concurrency limit.
+        GET /metrics - Prometheus metrics: per-agent call counts, latency histograms, tokens and cost, and per-stage latency.
     """
     }
 
@@ -48,6 +147,44 @@ async def beat_to_story():
     return beatbot.describe_pipeline()
 
 
+@app.get("/cache/stats/")
+async def cache_stats():
+    return response_cache.stats()
+
+
+@app.get("/coalesce/stats/")
+async def coalesce_stats():
+    return coalescer.stats()
+
+
+@app.get("/llm/stats/")
+async def llm_stats():
+    return rate_limiter.metrics()
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    limiter = rate_limiter.metrics()
+    cache = response_cache.stats()
+    coalesced = coalescer.stats()
+    gauges = {
+        "prompt2prose_llm_in_flight": limiter["in_flight"],
+        "prompt2prose_llm_waiting": limiter["waiting"],
+        "prompt2prose_llm_concurrency_limit": limiter["concurrency_limit"],
+        "prompt2prose_llm_retries": limiter["retries"],
+        "prompt2prose_llm_rate_limited": limiter["rate_limited"],
+        "prompt2prose_cache_hits": cache["hits"],
+        "prompt2prose_cache_misses": cache["misses"],
+        "prompt2prose_job_queue_depth": job_queue.depth,
+        "prompt2prose_coalesce_runs": coalesced["runs"],
+        "prompt2prose_coalesce_coalesced": coalesced["coalesced"],
+        "prompt2prose_coalesce_window_hits": coalesced["window_hits"],
+    }
+    return PlainTextResponse(
+        metrics.render(gauges), media_type="text/plain; version=0.0.4"
+    )
+
+
 @app.get("/docs/")
 async def docs():
     return RedirectResponse(
@@ -55,55 +192,187 @@ async def docs():
     )
 
 
-@app.post("/beat_to_story/generate/", response_model=StoryResponse)
-async def beat_to_story_generate(config: BeatConfig):
+def _run_for(config: BeatConfig) -> BeatToStory:
+    """Build an isolated run for a BeatConfig or BeatMetadataConfig payload."""
+    user_metadata = (
+        config.user_metadata.model_dump()
+        if isinstance(config, BeatMetadataConfig)
+        else None
+    )
+    return beatbot.new_run(
+        beats=config.beats,
+        user_metadata=user_metadata,
+        max_cost=config.max_cost,
+        max_seconds=config.max_seconds,
+        agent_models=config.agent_models,
+        idempotency_key=config.idempotency_key,
+    )
+
+
+async def _pipe(run: BeatToStory) -> None:
+    """
+    Run the pipeline, turning a budget too small for even the context into a 402
+    and an idempotency key reused for another request into a 409.
+    """
+    try:
+        await run.apipe()
+    except BudgetExceededError as e:
+        raise HTTPException(
+            status_code=402, detail={"error": str(e), **run.budget.summary()}
+        )
+    except IdempotencyConflictError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+
+async def _generate(kind: str, config: BeatConfig) -> StoryResponse:
+    """
+    Run a story request, or attach to the identical one already running (or just
+    finished) and return its response.
+    """
+
+    async def generate() -> StoryResponse:
+        start_time = datetime.now()
+        run = _run_for(config)
+        await _pipe(run)
+        return StoryResponse.from_run(
+            run, start_time, config.gen_metadata_flag, config.trace
+        )
+
+    key = RequestCoalescer.make_key(kind, config.model_dump())
+    return await coalescer.run(key, generate)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _stream_story(config: BeatConfig):
+    """Run the pipeline in a task and relay its stage events as server-sent events."""
     start_time = datetime.now()
+    run = _run_for(config)
+    events = asyncio.Queue()
+    run.event_handler = lambda event, data: events.put_nowait((event, data))
 
-    beatbot.beats = config.beats
-    beatbot.pipe()
+    task = asyncio.create_task(run.apipe())
+    task.add_done_callback(lambda _: events.put_nowait(None))
+    try:
+        while (item := await events.get()) is not None:
+            yield _sse(*item)
+        await task
+        response = StoryResponse.from_run(
+            run, start_time, config.gen_metadata_flag, config.trace
+        )
+        yield _sse("done", response.model_dump())
+    except Exception as e:
+        yield _sse("error", {"detail": str(e)})
+    finally:
+        task.cancel()
 
-    end_time = datetime.now()
 
-    return StoryResponse(
-        final_story=beatbot.edited_story,
-        final_story_word_count=beatbot.story_length,
-        generation_cost=beatbot.pipeline_cost(),
-        generation_time=(end_time - start_time).total_seconds(),
-        generation_metadata=(
-            beatbot.generation_metadata if config.gen_metadata_flag else {}
-        ),
-    )
+async def _run_job(kind: str, payload: dict, report) -> dict:
+    """JobQueue runner: run one queued story and report progress per stage."""
+    start_time = datetime.now()
+    config_cls = BeatMetadataConfig if kind == "metadata_to_story" else BeatConfig
+    config = config_cls(**payload)
+    run = _run_for(config)
+    passages = len(config.beats) - 1
+    edit_started = False
+
+    def on_event(event, data):
+        nonlocal edit_started
+        if event == "context":
+            report({"context": "done", "story": f"0/{passages}"})
+        elif event == "passage":
+            report({"story": f"{data['beat'] + 1}/{passages}"})
+        elif event in ("flow_token", "flow_window") and not edit_started:
+            edit_started = True
+            report({"edit": "running"})
+
+    run.event_handler = on_event
+    report({"context": "running"})
+    await run.apipe()
+    report({"edit": "done"})
+    return StoryResponse.from_run(
+        run, start_time, config.gen_metadata_flag, config.trace
+    ).model_dump()
+
+
+BATCH_MAX_CONCURRENCY = int(os.environ.get("PROMPT2PROSE_BATCH_MAX_CONCURRENCY", 8))
+# Caps the records running across every /batch/generate/ request, not just within one.
+batch_slots = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+job_store = JobStore(
+    path=os.environ.get("PROMPT2PROSE_JOB_DB", "prompt2prose_jobs.sqlite")
+)
+job_queue = JobQueue(
+    job_store,
+    _run_job,
+    max_workers=int(os.environ.get("PROMPT2PROSE_JOB_WORKERS", 4)),
+    max_queue_depth=int(os.environ.get("PROMPT2PROSE_JOB_QUEUE_DEPTH", 100)),
+)
+
+
+def _submit_job(kind: str, config: BeatConfig) -> JobResponse:
+    try:
+        job_id = job_queue.submit(kind, config.model_dump())
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    return JobResponse(job_id=job_id, status="queued")
+
+
+@app.post("/beat_to_story/generate/", response_model=StoryResponse)
+async def beat_to_story_generate(config: BeatConfig):
+    return await _generate("beat_to_story", config)
+
+
+@app.post("/beat_to_story/generate/stream/")
+async def beat_to_story_generate_stream(config: BeatConfig):
+    return StreamingResponse(_stream_story(config), media_type="text/event-stream")
 
 
 @app.post("/metadata_to_story/generate/", response_model=StoryResponse)
 async def metadata_to_story_generate(config: BeatMetadataConfig):
-    start_time = datetime.now()
+    return await _generate("metadata_to_story", config)
 
-    beatbot.beats = config.beats
-    genre = config.user_metadata.genre
-    style = config.user_metadata.style
 
-    if genre:
-        beatbot.genre = genre
-        beatbot.agents[f"{genre}_genre"] = StyleGenreAgent(style_guide=genre)
+@app.post("/metadata_to_story/generate/stream/")
+async def metadata_to_story_generate_stream(config: BeatMetadataConfig):
+    return StreamingResponse(_stream_story(config), media_type="text/event-stream")
 
-    if style:
-        beatbot.style = style
-        beatbot.agents[f"{style}_style"] = StyleGenreAgent(style_guide=style)
 
-    beatbot.user_metadata = config.user_metadata.model_dump()
+@app.post("/jobs/beat_to_story/", response_model=JobResponse, status_code=202)
+async def submit_beat_to_story_job(config: BeatConfig):
+    return _submit_job("beat_to_story", config)
 
-    beatbot.agents[f"meta"] = MetadataAgent()
 
-    beatbot.pipe()
-    end_time = datetime.now()
+@app.post("/jobs/metadata_to_story/", response_model=JobResponse, status_code=202)
+async def submit_metadata_to_story_job(config: BeatMetadataConfig):
+    return _submit_job("metadata_to_story", config)
 
-    return StoryResponse(
-        final_story=beatbot.edited_story,
-        final_story_word_count=beatbot.story_length,
-        generation_cost=beatbot.pipeline_cost(),
-        generation_time=(end_time - start_time).total_seconds(),
-        generation_metadata=(
-            beatbot.generation_metadata if config.gen_metadata_flag else {}
-        ),
-    )
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found.")
+    return JobResponse(**job)
+
+
+@app.post("/batch/generate/")
+async def batch_generate(request: Request, concurrency: int = 4):
+    """
+    Body: JSONL of BeatConfig/BeatMetadataConfig records (optionally with an "id").
+    Streams back one JSON line per record as it finishes. The body is read up front
+    (and held in memory): the streaming response listens on the same receive channel
+    for disconnects. Records of all batch requests share BATCH_MAX_CONCURRENCY slots.
+    """
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+    lines = (await request.body()).decode("utf-8").splitlines()
+
+    async def results():
+        async for result in iter_batch_results(
+            beatbot, lines, concurrency=concurrency, slots=batch_slots
+        ):
+            yield json.dumps(result) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
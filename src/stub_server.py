@@ -0,0 +1,46 @@
+import asyncio
+import json
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from utils import FakeBackend
+
+# OpenAI-compatible stand-in for load tests, e.g.
+#   PROMPT2PROSE_FAKE_LATENCY_MS=800 PROMPT2PROSE_FAKE_ERROR_RATE=0.05 uvicorn stub_server:app --port 8001
+# then run the API with PROMPT2PROSE_LLM_BASE_URL=http://localhost:8001/v1 and any OPENAI_KEY.
+app = FastAPI()
+backend = FakeBackend.from_env()
+
+
+def _error(status: int) -> JSONResponse:
+    kind = {429: "rate_limit_exceeded", 504: "timeout"}.get(status, "server_error")
+    return JSONResponse(
+        status_code=status,
+        content={"error": {"message": f"Simulated {kind}", "type": kind}},
+        headers={"retry-after-ms": "200"} if status == 429 else None,
+    )
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    latency = backend.sample_latency()
+    status = backend.sample_error()
+
+    if not body.get("stream"):
+        await asyncio.sleep(latency)
+        return _error(status) if status else backend.completion(**body)
+
+    await asyncio.sleep(latency / 2)
+    if status:
+        return _error(status)
+    chunks = backend.chunks(backend.completion(**body))
+
+    async def events():
+        for chunk in chunks:
+            await asyncio.sleep(latency / 2 / len(chunks))
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
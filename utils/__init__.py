@@ -1,4 +1,17 @@
 from utils.agents import *
 from utils.api_utils import *
+from utils.backend_utils import *
+from utils.batch_utils import *
+from utils.benchmark_utils import *
+from utils.budget_utils import *
+from utils.cache_utils import *
+from utils.coalesce_utils import *
+from utils.context_utils import *
+from utils.job_utils import *
 from utils.llm_utils import *
+from utils.model_utils import *
+from utils.prefilter_utils import *
+from utils.state_utils import *
 from utils.story_utils import *
+from utils.trace_utils import *
+from utils.validation_utils import *
@@ -1,31 +1,101 @@
+import copy
 import json
+import threading
 from abc import ABC, abstractmethod
-from typing import Any
+from collections import OrderedDict
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
 
-from utils.llm_utils import chat_with_gpt
+from utils.backend_utils import DEFAULT_MODEL
+from utils.llm_utils import achat_with_gpt, astream_chat_with_gpt, chat_with_gpt
+from utils.prefilter_utils import ScoredVerdict, score_passage
 
 
 class Agent(ABC):
+    """
+    Base class for the pipeline agents.
+    Agents are shared by every run, so they keep no per-call state: what a call
+    costs is tracked by track_usage() and charged to the run that made it.
+    Requests are laid out for provider prompt caching: the system prompt holds only
+    static instructions and is byte-identical on every call, and each user prompt
+    puts its fixed instructions before the per-call content (beats, passages, context).
+    """
+
     def __init__(
-        self, system_prompt: str, llm: str = "gpt-3.5-turbo", temperature: float = 0.0
+        self, system_prompt: str, llm: str = DEFAULT_MODEL, temperature: float = 0.0
     ):
         self.system_prompt = system_prompt
-        self.token_cost = 0.0
         self.temperature = temperature
         self.llm = llm
+        # Opt-in ResponseCache; only worth setting on deterministic agents.
+        self.cache = None
 
     @abstractmethod
+    def build_request(self, *args, **kwargs) -> Dict[str, Any]:
+        """
+        Build the chat_with_gpt keyword arguments (messages, temperature, max_tokens)
+        for one call. Shared by the sync and async paths.
+        """
+        pass
+
+    def parse_response(self, response_text: str) -> Any:
+        """Turn the raw LLM response into the agent's output."""
+        return response_text
+
     def __call__(self, *args, **kwargs) -> Any:
         """
         Execute the agent's primary function
         """
-        pass
+        response_text, _ = chat_with_gpt(
+            **self.build_request(*args, **kwargs), model=self.llm, cache=self.cache
+        )
+        return self.parse_response(response_text)
+
+    async def acall(self, *args, **kwargs) -> Any:
+        """
+        Async version of __call__, awaits the LLM without blocking the event loop.
+        """
+        response_text, _ = await achat_with_gpt(
+            **self.build_request(*args, **kwargs), model=self.llm, cache=self.cache
+        )
+        return self.parse_response(response_text)
+
+    async def astream(self, *args, **kwargs) -> AsyncIterator[Tuple[str, float]]:
+        """
+        Streaming version of acall, yields (text_delta, cost) pairs as the LLM writes.
+        The raw text is not passed through parse_response, so use it for free-text agents.
+        """
+        request = self.build_request(*args, **kwargs)
+        # Closing this generator early closes the API stream too, see astream_chat_with_gpt.
+        async with aclosing(astream_chat_with_gpt(**request, model=self.llm)) as stream:
+            async for delta, cost in stream:
+                yield delta, cost
+
+    def with_model(self, llm: str) -> "Agent":
+        """
+        Copy of this agent that calls llm instead. Agents are shared between runs,
+        so a run reroutes one by swapping in a copy; agents without an LLM are returned as is.
+        """
+        if not self.llm or llm == self.llm:
+            return self
+        agent = copy.copy(self)
+        agent.llm = llm
+        return agent
 
     def describe(self) -> str:
         return f"{self.__class__.__name__}\n llm: {self.llm} -Note: Only GPT support atm \n Agentic Prompt:{self.system_prompt}\n"
 
-    def get_cost(self):
-        return self.token_cost
+
+class LocalAgent(Agent):
+    """
+    Base class for agents that run locally without an LLM; they override __call__
+    and acall instead of building a request.
+    """
+
+    def build_request(self, *args, **kwargs) -> Dict[str, Any]:
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not call an LLM; override __call__ instead."
+        )
 
 
 class ContextAgent(Agent):
@@ -62,7 +132,7 @@ class ContextAgent(Agent):
         If no previous context, set change flags to false."""
         )
 
-    def __call__(self, beat, previous_context=None):
+    def build_request(self, beat, previous_context=None):
         """
         Analyzes a beat and (optionally) compares it with the previous context.
         Returns a JSON-formatted summary of the scene, e.g.:
@@ -77,19 +147,19 @@ class ContextAgent(Agent):
         # Build the user prompt. If previous_context exists, include it.
         if previous_context:
             user_prompt = (
-                f"Previous Context (JSON):\n{previous_context}\n\n"
-                f'New Beat:\n"{beat}"\n\n'
                 "Compare the new beat to the previous context. If the new beat describes the same setting, mark 'location_change' as false; "
                 "if it indicates a different location, mark it as true and update the 'setting' object."
                 "For each character mentioned, compare with previous context: if their 'character_location' remains the same, mark 'status_change' as false; "
                 "if it changes or a new character is introduced, mark it as true. "
-                "Return the updated scene context in valid JSON format."
+                "Return the updated scene context in valid JSON format.\n\n"
+                f"Previous Context (JSON):\n{previous_context}\n\n"
+                f'New Beat:\n"{beat}"'
             )
         else:
             user_prompt = (
-                f'New Beat:\n"{beat}"\n\n'
                 "Extract the scene context. Identify the location and any characters along with their involvement (e.g., 'on stage' or 'off stage'). "
-                "Return the result in valid JSON format with keys 'setting' and 'characters'."
+                "Return the result in valid JSON format with keys 'setting' and 'characters'.\n\n"
+                f'New Beat:\n"{beat}"'
             )
 
         messages = [
@@ -97,8 +167,9 @@ class ContextAgent(Agent):
             {"role": "user", "content": user_prompt},
         ]
 
-        response_text, cost = chat_with_gpt(messages, temperature=self.temperature)
+        return {"messages": messages, "temperature": self.temperature}
 
+    def parse_response(self, response_text):
         try:
             # Try to parse the JSON output.
             context_json = json.loads(response_text)
@@ -107,7 +178,6 @@ class ContextAgent(Agent):
             print("Failed to parse context agent output:", response_text)
             context_json = {}
 
-        self.token_cost += cost
         return context_json
 
 
@@ -117,9 +187,8 @@ class ProseAgent(Agent):
         self.max_words = max_words
 
         super().__init__(
-            system_prompt="""You are ProseAgent, a creative writing assistant specialized in connecting narrative story beats.
-        Current scene context: {context_summary}"""
-            + f"""Before writing:
+            system_prompt=f"""You are ProseAgent, a creative writing assistant specialized in connecting narrative story beats.
+        Before writing:
          1. Think through the key scene details: confirm the location and ensure all characters are actively engaged.
          2. outline the scene - confirm the previous details of the story and the current story beat, and make sure the story flows normally.
             - For instance if a communication has ended don't continue that conversation.
@@ -131,33 +200,54 @@ class ProseAgent(Agent):
             temperature=0.3,
         )
 
-    def __call__(self, previous_passage, beat_a, beat_b, context_summary):
-        system_message = self.system_prompt.format(context_summary=context_summary)
-
+    def build_request(
+        self, previous_passage, beat_a, beat_b, context_summary, feedback=None
+    ):
+        """
+        Build the request for one passage.
+        Arguments:
+        - previous_passage: The passage before this one, or None for the first beat pair.
+        - beat_a, beat_b: The beats to connect.
+        - context_summary: The encoded scene context.
+        - feedback: Why the previous attempt at this passage was rejected, if it was.
+          It goes last, so retries share the prompt prefix of the first attempt.
+        max_tokens leaves room for half again max_words, so an overlong passage is
+        cut by the stream's word count rather than mid-sentence by the token cap.
+        """
+        # The scene context goes in the user prompt, after the instructions, so the
+        # system prompt stays the same for every beat.
+        length = f"Ensure your response is between {self.min_words} and {self.max_words} words.\n\n"
         if previous_passage:
             user_prompt = (
-                f'Here is the previous narrative passage:\n"{previous_passage}"\n\n'
-                f'This is the next story beat:\n"{beat_b}"\n\n'
-                f"**Current Scene Context:** {context_summary}\n\n"
                 "Please think through the scene details and then generate a connecting passage that continues the narrative seamlessly and in a way that makes narrative sense. "
-                "Ensure your response is between 100 and 150 words."
+                f"{length}"
+                f"**Current Scene Context:** {context_summary}\n\n"
+                f'Here is the previous narrative passage:\n"{previous_passage}"\n\n'
+                f'This is the next story beat:\n"{beat_b}"'
             )
         else:
             user_prompt = (
-                f'Here are two story beats:\nBeat A: "{beat_a}"\nBeat B: "{beat_b}"\n\n'
-                f"**Current Scene Context:** {context_summary}\n\n"
                 "Please think through the scene details first (confirm the location and character engagement), then generate a connecting narrative passage that bridges these beats creatively and seamlessly. "
-                "Ensure your response is between 100 and 150 words."
+                f"{length}"
+                f"**Current Scene Context:** {context_summary}\n\n"
+                f'Here are two story beats:\nBeat A: "{beat_a}"\nBeat B: "{beat_b}"'
+            )
+        if feedback:
+            user_prompt += (
+                f"\n\nYour previous attempt at this passage was rejected. {feedback} "
+                "Write a new passage that fixes this."
             )
 
         messages = [
-            {"role": "system", "content": system_message},
+            {"role": "system", "content": self.system_prompt},
             {"role": "user", "content": user_prompt},
         ]
 
-        response_text, cost = chat_with_gpt(messages, temperature=self.temperature)
-        self.token_cost += cost
-        return response_text
+        return {
+            "messages": messages,
+            "max_tokens": int(4 / 3 * self.max_words * 1.5) + 20,
+            "temperature": self.temperature,
+        }
 
 
 class StoryAgent(Agent):
@@ -172,7 +262,7 @@ class StoryAgent(Agent):
             temperature=0.0,
         )
 
-    def __call__(self, passage, beats):
+    def build_request(self, passage, beats):
         """
         Checks whether the newly generated passage is fully consistent with the provided story beats.
         The passage is considered acceptable if it either reflects both beats or if it focuses solely on the second beat.
@@ -180,16 +270,17 @@ class StoryAgent(Agent):
         either both beats or solely the second beat without extraneous details), or "False" if it does not.
         """
 
-        # Build the user prompt.
+        # Build the user prompt. Beats come before the passage: every candidate for a
+        # beat pair then shares the prompt up to the passage itself.
         user_prompt = (
-            f'Review the following passage:\n"{passage}"\n\n'
-            "Against these story beats:\n"
+            "The passage is acceptable if it either reflects both beats or if it faithfully reflects only the second beat. "
+            "Return ONLY 'True' if this is the case, otherwise return ONLY 'False'.\n\n"
+            "Story beats:\n"
         )
         for idx, beat in enumerate(beats, start=1):
             user_prompt += f'Beat {idx}: "{beat}"\n'
         user_prompt += (
-            "\nThe passage is acceptable if it either reflects both beats or if it faithfully reflects only the second beat. "
-            "Return ONLY 'True' if this is the case, otherwise return ONLY 'False'."
+            f'\nReview the following passage against these beats:\n"{passage}"'
         )
 
         messages = [
@@ -197,12 +288,10 @@ class StoryAgent(Agent):
             {"role": "user", "content": user_prompt},
         ]
 
-        response, cost = chat_with_gpt(messages, temperature=self.temperature)
-        self.token_cost += cost
-        return response
+        return {"messages": messages, "temperature": self.temperature}
 
 
-class LengthAgent(Agent):
+class LengthAgent(LocalAgent):
     def __init__(self, min_words: int = 100, max_words: int = 150):
         super().__init__(
             system_prompt="""
@@ -236,6 +325,52 @@ class LengthAgent(Agent):
         else:
             return "False"
 
+    async def acall(self, passage):
+        return self(passage)
+
+
+class PrefilterAgent(LocalAgent):
+    def __init__(
+        self, reject_below: float = 0.02, accept_above: Optional[float] = None
+    ):
+        super().__init__(
+            system_prompt="""
+        This is PrefilterAgent, a local consistency scorer that runs before StoryAgent.
+        Note: This does not use an AI model; it scores the passage's hashed bag-of-words similarity to the beats
+        and checks that it names the characters of the second beat and the context's location.
+        """,
+            llm=None,
+        )
+        self.reject_below = reject_below
+        self.accept_above = accept_above
+
+    def __call__(self, passage, beats, context=None):
+        """
+        Returns "False" for clear failures: the passage names none of beat B's characters,
+        or its similarity to the beats is below reject_below.
+        Returns "True" for clear passes, only if accept_above is set: similarity at or above
+        it, every beat B character named, and the context's location mentioned.
+        Anything else is "Unsure", left to the LLM check.
+        The verdict carries the similarity as its score.
+        """
+        signals = score_passage(passage, beats, context)
+        similarity = signals["similarity"]
+        if (
+            signals["names"] and not signals["named"]
+        ) or similarity < self.reject_below:
+            return ScoredVerdict("False", similarity)
+        if (
+            self.accept_above is not None
+            and similarity >= self.accept_above
+            and signals["named"] == len(signals["names"])
+            and signals["location"] != 0.0
+        ):
+            return ScoredVerdict("True", similarity)
+        return ScoredVerdict("Unsure", similarity)
+
+    async def acall(self, passage, beats, context=None):
+        return self(passage, beats, context)
+
 
 class FlowAgent(Agent):
     def __init__(self):
@@ -251,32 +386,51 @@ class FlowAgent(Agent):
             - Do not alter any factual details, change the location, or add new plot points
             —simply polish the text.
             - Try to maintain the original tone and mood of the story.
-            - Try to aim for around {max_words} in your edited version.
+            - Try to aim for the word count given with the story in your edited version.
         Once you consider those points, return the revised story.""",
             temperature=0.0,
         )
 
-    def __call__(self, full_story, max_words=1500):
-        system_message = self.system_prompt.format(max_words=max_words)
-
-        user_prompt = (
-            f'Review the following story and improve its overall narrative flow, avoiding repetitive sentence structures and dull language:\n\n"{full_story}"\n\n'
-            "Return the revised story. Make sure the context (location, characters, and story beats) remains consistent."
-        )
+    def build_request(self, full_story, max_words=1500, preceding=None, following=None):
+        """
+        Build the edit request for a whole story, or for one window of it.
+        Arguments:
+        - full_story: The text to edit.
+        - max_words: Target length of the edited text.
+        - preceding, following: Optional neighbouring passages, shown read-only so the
+          edited window joins smoothly onto text that is edited separately.
+        """
+        if preceding is None and following is None:
+            user_prompt = (
+                "Review the following story and improve its overall narrative flow, avoiding repetitive sentence structures and dull language. "
+                "Return the revised story. Make sure the context (location, characters, and story beats) remains consistent.\n\n"
+                f"Aim for around {max_words} words.\n\n"
+                f'Story:\n"{full_story}"'
+            )
+        else:
+            user_prompt = (
+                "You are editing one section of a longer story. The surrounding passages are for reference only; do not revise or repeat them. "
+                "Improve the narrative flow of the section, avoiding repetitive sentence structures and dull language, so that it reads smoothly out of the preceding passage and into the following one. "
+                "Return only the revised section. Make sure the context (location, characters, and story beats) remains consistent.\n\n"
+                f"Aim for around {max_words} words.\n\n"
+                f'Preceding passage (read-only):\n"{preceding or "(start of story)"}"\n\n'
+                f'Section to revise:\n"{full_story}"\n\n'
+                f'Following passage (read-only):\n"{following or "(end of story)"}"'
+            )
 
         messages = [
-            {"role": "system", "content": system_message},
+            {"role": "system", "content": self.system_prompt},
             {"role": "user", "content": user_prompt},
         ]
 
-        response_text, cost = chat_with_gpt(
-            messages, max_tokens=int(4 / 3 * max_words + 50), temperature=0.0
-        )
-        self.token_cost += cost
-        return response_text
+        return {
+            "messages": messages,
+            "max_tokens": int(4 / 3 * max_words + 50),
+            "temperature": 0.0,
+        }
 
 
-class MetadataAgent(Agent):
+class MetadataAgent(LocalAgent):
     def __init__(self):
         super().__init__(
             system_prompt="""
@@ -325,19 +479,102 @@ class MetadataAgent(Agent):
             beat_to_story_context[beat_num] = enriched_context
         return beat_to_story_context
 
+    async def acall(self, beat_to_story_context: dict, metadata: dict) -> dict:
+        return self(beat_to_story_context, metadata)
+
+
+class ContextDiffAgent(LocalAgent):
+    def __init__(self):
+        super().__init__(
+            system_prompt="""
+        This is ContextDiffAgent, it walks contexts that were extracted independently per beat
+        and sets location_change and status_change by comparing each beat with the one before.
+        Note: This does not use an AI model;
+        """,
+            llm=None,
+        )
+
+    @staticmethod
+    def _normalize(value) -> str:
+        return " ".join(str(value or "").lower().split())
+
+    def __call__(self, beat_to_story_context: dict) -> dict:
+        """
+        Updates context dictionary in-place with change flags
+        Args:
+            beat_to_story_context: Contexts keyed by beat index, each extracted without a previous context
+        """
+        previous = None
+        for beat_num in sorted(beat_to_story_context):
+            context = beat_to_story_context[beat_num] or {}
+            setting = dict(context.get("setting") or {})
+            setting.setdefault("location", "")
+            setting.setdefault("important_details", "")
+            characters = [dict(char) for char in context.get("characters") or []]
+
+            if previous is None:
+                setting["location_change"] = False
+                for char in characters:
+                    char["status_change"] = False
+            else:
+                location = self._normalize(setting["location"])
+                if not location or location == "unknown":
+                    # Extraction could not place the beat; assume the scene continues.
+                    setting["location"] = previous["setting"]["location"]
+                    location = self._normalize(setting["location"])
+                setting["location_change"] = location != self._normalize(
+                    previous["setting"]["location"]
+                )
+
+                previous_chars = {
+                    self._normalize(char.get("name")): char
+                    for char in previous["characters"]
+                }
+                for char in characters:
+                    char.setdefault("character_location", "on stage")
+                    before = previous_chars.get(self._normalize(char.get("name")))
+                    char["status_change"] = before is None or self._normalize(
+                        before.get("character_location")
+                    ) != self._normalize(char["character_location"])
+
+            for char in characters:
+                char.setdefault("name", "")
+                char.setdefault("character_location", "on stage")
+
+            beat_to_story_context[beat_num] = {
+                "setting": setting,
+                "characters": characters,
+            }
+            previous = beat_to_story_context[beat_num]
+        return beat_to_story_context
+
+    async def acall(self, beat_to_story_context: dict) -> dict:
+        return self(beat_to_story_context)
+
 
 class StyleGenreAgent(Agent):
-    def __init__(self, style_guide: str):
+    def __init__(self, style_guide: str, genre: Optional[str] = None):
+        """
+        Rewrites passages in style_guide. With genre as well, one call applies the genre
+        and the style together, instead of a genre rewrite followed by a style rewrite.
+        """
+        target = f"Target style: {style_guide}"
+        if genre:
+            target = (
+                "Apply the target genre and the target style together in a single rewrite: "
+                "the genre's tone and imagery, told in the style's voice and form.\n\n"
+                f"            Target genre: {genre}\n            {target}"
+            )
         super().__init__(
-            system_prompt=f"""You are an expert {style_guide} editor with decades of experience.
-            Your job is to aggressively rewrite passages to match the {style_guide} style perfectly.
-            Before rewriting plan out the language and tone necessary for the {style_guide} style.
+            system_prompt=f"""You are an expert style editor with decades of experience.
+            Your job is to aggressively rewrite passages to match the target style perfectly.
+            Before rewriting plan out the language and tone necessary for the target style.
 
             When rewriting, consider:
-            - Word choice and vocabulary specific to {style_guide}
-            - Sentence structure and pacing typical of {style_guide}
-            - Metaphors and descriptions that would appear in {style_guide}
-            - Emotional tone and atmosphere characteristic of {style_guide}
+            - Word choice and vocabulary specific to the target style
+            - Sentence structure and pacing typical of the target style
+            - Metaphors and descriptions that would appear in the target style
+            - Emotional tone and atmosphere characteristic of the target style
 
             Examples of what this means:
             - For "noir": Use terse sentences, cynical tone, vivid sensory details, morally ambiguous descriptions
@@ -347,17 +584,20 @@ class StyleGenreAgent(Agent):
             - For "screenplay": Story is entirely action lines, stage direction, and character dialogue in screenplay format
             - For "newspaper": Use journalistic language, inverted pyramid structure, and objective reporting style
 
-            IMPORTANT: While maintaining the core story events and character actions, you should completely transform the prose of writing to match {style_guide}.""",
+            IMPORTANT: While maintaining the core story events and character actions, you should completely transform the prose of writing to match the target style.
+
+            {target}""",
             temperature=0.0,  # Higher temperature for more creative variation
         )
         self.style_guide = style_guide
+        self.genre = genre
 
-    def __call__(self, passage: str) -> str:
+    def build_request(self, passage: str) -> Dict[str, Any]:
         # No need for style_guide parameter since it's stored in the instance
         user_prompt = (
-            f'Rewrite this passage in pure {self.style_guide} style:\n"{passage}"\n\n'
             "Be bold with your stylistic changes while keeping the same basic events and character actions.\n"
-            f"Maintain approximately {len(passage.split())} words."
+            f"Rewrite this passage {f'as {self.genre} ' if self.genre else ''}in pure {self.style_guide} style, in approximately {len(passage.split())} words:\n"
+            f'"{passage}"'
         )
 
         messages = [
@@ -365,9 +605,56 @@ class StyleGenreAgent(Agent):
             {"role": "user", "content": user_prompt},
         ]
 
-        response_text, cost = chat_with_gpt(
-            messages,
-            temperature=self.temperature,
-        )
-        self.token_cost += cost
-        return response_text
+        return {"messages": messages, "temperature": self.temperature}
+
+
+class StyleGenreRegistry:
+    """
+    Bounded pool of StyleGenreAgents shared by every run of a pipeline, keyed by
+    their guide (genre, style, or a genre+style pair for fused rewrites). Requests
+    with the same guide reuse one agent; the least recently used one is dropped
+    once max_agents are held, so arbitrary style strings cannot grow it without bound.
+    """
+
+    def __init__(
+        self,
+        max_agents: int = 32,
+        prepare: Optional[Callable[[Agent], Agent]] = None,
+    ):
+        """
+        Arguments:
+        - max_agents: Agents kept before the least recently used is evicted.
+        - prepare: Called on each new agent, e.g. to opt it into the response cache.
+        """
+        self.max_agents = max_agents
+        self.prepare = prepare
+        self._agents: "OrderedDict[Tuple[str, ...], StyleGenreAgent]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, style_guide: str, genre: Optional[str] = None) -> StyleGenreAgent:
+        key = (genre, style_guide) if genre else (style_guide,)
+        with self._lock:
+            agent = self._agents.get(key)
+            if agent is not None:
+                self._agents.move_to_end(key)
+                return agent
+            agent = StyleGenreAgent(style_guide=style_guide, genre=genre)
+            if self.prepare is not None:
+                agent = self.prepare(agent)
+            self._agents[key] = agent
+            while len(self._agents) > self.max_agents:
+                self._agents.popitem(last=False)
+                self.evictions += 1
+            return agent
+
+    def __len__(self) -> int:
+        return len(self._agents)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "agents": len(self._agents),
+                "max_agents": self.max_agents,
+                "evictions": self.evictions,
+            }
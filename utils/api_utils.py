@@ -1,19 +1,58 @@
-from typing import Dict, List, Optional
+from datetime import datetime
+from typing import Any, Dict, List, Optional
 
-from pydantic import BaseModel, Field, config
+from pydantic import BaseModel, Field, config, field_validator
+
+from utils.model_utils import resolve_model
 
 
 class BeatConfig(BaseModel):
     beats: List[str] = Field(..., min_items=1)
     gen_metadata_flag: bool = False
+    max_cost: Optional[float] = Field(None, gt=0)
+    max_seconds: Optional[float] = Field(None, gt=0)
+    # Return every agent call and stage of the run as a JSON trace.
+    trace: bool = False
+    # Per-agent model routes, e.g. {"story": "fast", "prose": "gpt-4o"}.
+    agent_models: Optional[Dict[str, str]] = None
+    # Client key to checkpoint the run under; a retry with the same key resumes it.
+    idempotency_key: Optional[str] = Field(None, min_length=1, max_length=255)
+
+    @field_validator("agent_models")
+    @classmethod
+    def check_agent_models(cls, value):
+        for route in (value or {}).values():
+            resolve_model(route)
+        return value
 
 
 class StoryResponse(BaseModel):
     final_story: str
     final_story_word_count: int
-    generation_cost: Dict[str, float]
+    generation_cost: Dict[str, Any]
     generation_time: float
     generation_metadata: dict = None
+    generation_budget: Optional[Dict[str, Any]] = None
+    generation_trace: Optional[List[Dict[str, Any]]] = None
+
+    @classmethod
+    def from_run(
+        cls,
+        run,
+        start_time: datetime,
+        gen_metadata_flag: bool = False,
+        include_trace: bool = False,
+    ) -> "StoryResponse":
+        """Summarize a finished BeatToStory run."""
+        return cls(
+            final_story=run.edited_story,
+            final_story_word_count=run.story_length,
+            generation_cost=run.pipeline_cost(),
+            generation_time=(datetime.now() - start_time).total_seconds(),
+            generation_metadata=(run.generation_metadata if gen_metadata_flag else {}),
+            generation_budget=run.budget.summary() if run.budget else None,
+            generation_trace=run.trace.dump() if include_trace else None,
+        )
 
 
 class CharacterInfo(BaseModel):
@@ -35,3 +74,11 @@ class MetadataConfig(BaseModel):
 
 class BeatMetadataConfig(BeatConfig):
     user_metadata: MetadataConfig
+
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    progress: Dict[str, Any] = {}
+    result: Optional[StoryResponse] = None
+    error: Optional[str] = None
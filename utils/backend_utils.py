@@ -0,0 +1,359 @@
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+import weakref
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import httpx
+from openai import (
+    APITimeoutError,
+    AsyncOpenAI,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+# Model of every agent that does not name its own, and of calls that name none.
+DEFAULT_MODEL = os.environ.get("PROMPT2PROSE_MODEL", "gpt-3.5-turbo")
+
+
+class LLMBackend(ABC):
+    """
+    Where chat completions come from. chat_with_gpt and friends build the request
+    (model, messages, max_tokens, temperature, and stream options) and hand it to
+    the configured backend, which returns OpenAI-shaped completions or chunk streams.
+    Attributes:
+        model (str): Model requested for calls that do not name one.
+    """
+
+    model: str = DEFAULT_MODEL
+
+    @abstractmethod
+    def create(self, **request) -> ChatCompletion:
+        """Blocking chat completion."""
+
+    @abstractmethod
+    async def acreate(self, **request) -> Any:
+        """Async chat completion; an async iterator of chunks when request["stream"] is set."""
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    The OpenAI API, or any server speaking its chat completions protocol.
+    Clients are created on first use, so importing the package needs no API key.
+    Attributes:
+        model (str): Model to request.
+        api_key (str): API key, defaults to the OPENAI_KEY environment variable.
+        base_url (str): Alternative OpenAI-compatible endpoint, e.g. the local stub server.
+    """
+
+    def __init__(
+        self,
+        model: str = DEFAULT_MODEL,
+        api_key: Optional[str] = None,
+        base_url: Optional[str] = None,
+    ):
+        self.model = model
+        self.api_key = api_key or os.environ.get("OPENAI_KEY")
+        self.base_url = base_url
+        self._client = None
+        # AsyncOpenAI pools connections per event loop, so keep one client per loop.
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    @property
+    def client(self) -> OpenAI:
+        # Retries are handled by the rate limiter, so the SDK's own retries are off.
+        if self._client is None:
+            self._client = OpenAI(
+                api_key=self.api_key, base_url=self.base_url, max_retries=0
+            )
+        return self._client
+
+    def async_client(self) -> AsyncOpenAI:
+        """Return the AsyncOpenAI client bound to the running event loop."""
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            self._async_clients[loop] = AsyncOpenAI(
+                api_key=self.api_key, base_url=self.base_url, max_retries=0
+            )
+        return self._async_clients[loop]
+
+    def create(self, **request) -> ChatCompletion:
+        return self.client.chat.completions.create(**request)
+
+    async def acreate(self, **request) -> Any:
+        return await self.async_client().chat.completions.create(**request)
+
+
+_CONTEXT_RESPONSE = {
+    "setting": {
+        "location": "the observation deck",
+        "location_change": False,
+        "important_details": "quiet hum of machinery, stars outside the glass",
+    },
+    "characters": [
+        {"name": "Jack", "character_location": "on stage", "status_change": False}
+    ],
+}
+
+_PROSE_WORDS = (
+    "the light moved slowly across the deck while she listened for the engines. "
+    "he waited with one hand on the rail, counting the seconds between each "
+    "pulse of the old station as the dark pressed close against the glass."
+).split()
+
+
+class FakeBackend(LLMBackend):
+    """
+    In-process stand-in for the API that needs no network or key.
+    It answers every agent with output that passes the pipeline's checks: JSON for
+    ContextAgent, "True" for StoryAgent (or "False" at rejection_rate), and prose of
+    the length each prompt asks for, which restates the beat it leads into.
+    Latency, errors and token counts are simulated so the rate limiter, retries,
+    caches and scheduling can be exercised offline.
+    Attributes:
+        latency_ms (float): Median latency of a call.
+        latency_sigma (float): Spread of the log-normal latency distribution, 0 for fixed latency.
+        error_rate (float): Chance a call fails with a 429, a 500 or a timeout.
+        rejection_rate (float): Chance StoryAgent answers "False".
+        length_failure_rate (float): Chance a ProseAgent passage comes back too short
+            or too long (evenly split) for the length check.
+        tokens_per_word (float): Completion tokens counted per generated word.
+        cached_fraction (float): Share of prompt tokens reported as prompt-cache hits.
+        seed (int): Seed for reproducible runs.
+    Answered calls are counted per agent in `calls`, injected failures in `errors`.
+    """
+
+    def __init__(
+        self,
+        model: str = DEFAULT_MODEL,
+        latency_ms: float = 300.0,
+        latency_sigma: float = 0.5,
+        error_rate: float = 0.0,
+        rejection_rate: float = 0.0,
+        length_failure_rate: float = 0.0,
+        tokens_per_word: float = 4 / 3,
+        cached_fraction: float = 0.0,
+        seed: Optional[int] = None,
+    ):
+        self.model = model
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rejection_rate = rejection_rate
+        self.length_failure_rate = length_failure_rate
+        self.tokens_per_word = tokens_per_word
+        self.cached_fraction = cached_fraction
+        self.seed = seed
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls: Dict[str, int] = {}
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls, model: str = DEFAULT_MODEL) -> "FakeBackend":
+        env = os.environ.get
+        seed = env("PROMPT2PROSE_FAKE_SEED")
+        return cls(
+            model=model,
+            latency_ms=float(env("PROMPT2PROSE_FAKE_LATENCY_MS", 300)),
+            latency_sigma=float(env("PROMPT2PROSE_FAKE_LATENCY_SIGMA", 0.5)),
+            error_rate=float(env("PROMPT2PROSE_FAKE_ERROR_RATE", 0)),
+            rejection_rate=float(env("PROMPT2PROSE_FAKE_REJECTION_RATE", 0)),
+            length_failure_rate=float(env("PROMPT2PROSE_FAKE_LENGTH_FAILURE_RATE", 0)),
+            cached_fraction=float(env("PROMPT2PROSE_FAKE_CACHED_FRACTION", 0)),
+            seed=int(seed) if seed is not None else None,
+        )
+
+    def reseed(self, salt: str) -> None:
+        """Restart the random stream from (seed, salt), e.g. once per benchmark scenario."""
+        with self._lock:
+            self._rng.seed(f"{self.seed}:{salt}")
+
+    def _random(self) -> float:
+        with self._lock:
+            return self._rng.random()
+
+    def sample_latency(self) -> float:
+        """Seconds the next call takes, log-normal around latency_ms."""
+        with self._lock:
+            noise = (
+                self._rng.gauss(0.0, self.latency_sigma) if self.latency_sigma else 0
+            )
+        return self.latency_ms / 1000 * math.exp(noise)
+
+    def sample_error(self) -> Optional[int]:
+        """HTTP status the next call fails with (429, 500, or 504 for a timeout), or None."""
+        if self._random() >= self.error_rate:
+            return None
+        with self._lock:
+            self.errors += 1
+            return self._rng.choice((429, 500, 504))
+
+    @staticmethod
+    def agent_kind(system: str) -> str:
+        """Which agent sent a request, judged from its system prompt."""
+        for kind, marker in (
+            ("context", "ContextAgent"),
+            ("story", "StoryAgent"),
+            ("prose", "ProseAgent"),
+            ("flow", "FlowAgent"),
+            ("style", "style editor"),
+        ):
+            if marker in system:
+                return kind
+        return "other"
+
+    def _reply(self, messages: List[Dict[str, str]]) -> str:
+        system = messages[0]["content"] if messages else ""
+        prompt = messages[-1]["content"] if messages else ""
+        kind = self.agent_kind(system)
+        with self._lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+        if kind == "context":
+            return json.dumps(_CONTEXT_RESPONSE)
+        if kind == "story":
+            return "False" if self._random() < self.rejection_rate else "True"
+
+        words = 120
+        bounds = re.search(r"between (\d+) and (\d+) words", system)
+        target = re.search(r"(?:around|approximately) (\d+) words", prompt)
+        if bounds:
+            low, high = int(bounds.group(1)), int(bounds.group(2))
+            with self._lock:
+                words = self._rng.randint(low, high)
+            if self._random() < self.length_failure_rate:
+                words = max(1, low // 2) if self._random() < 0.5 else high * 2
+        elif target:
+            words = int(target.group(1))
+        # Prose restates the beat it leads into, so it names that beat's characters.
+        beat = re.search(r'(?:Beat B: |next story beat:\n)"(.*?)"', prompt, re.S)
+        vocabulary = (beat.group(1).split() if beat else []) + _PROSE_WORDS
+        return " ".join(vocabulary[i % len(vocabulary)] for i in range(words))
+
+    def _usage(self, messages: List[Dict[str, str]], text: str) -> Dict[str, Any]:
+        prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4 + 1
+        completion_tokens = math.ceil(len(text.split()) * self.tokens_per_word)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {
+                "cached_tokens": int(prompt_tokens * self.cached_fraction)
+            },
+        }
+
+    def completion(self, **request) -> Dict[str, Any]:
+        """The chat completion for request, as the JSON body the API would return."""
+        text = self._reply(request["messages"])
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", self.model),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": text},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": self._usage(request["messages"], text),
+        }
+
+    @staticmethod
+    def chunks(completion: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Split a completion into stream chunks, one per word, then a usage chunk."""
+        base = {
+            "id": completion["id"],
+            "object": "chat.completion.chunk",
+            "created": completion["created"],
+            "model": completion["model"],
+        }
+        words = completion["choices"][0]["message"]["content"].split(" ")
+        chunks = [
+            {
+                **base,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": word if i == 0 else " " + word},
+                        "finish_reason": None,
+                    }
+                ],
+            }
+            for i, word in enumerate(words)
+        ]
+        chunks.append({**base, "choices": [], "usage": completion["usage"]})
+        return chunks
+
+    @staticmethod
+    def error(status: int) -> Exception:
+        """The exception the OpenAI client raises for a failed call."""
+        request = httpx.Request("POST", "http://fake-backend/v1/chat/completions")
+        if status == 504:
+            return APITimeoutError(request=request)
+        response = httpx.Response(status, request=request)
+        if status == 429:
+            return RateLimitError("Simulated rate limit", response=response, body=None)
+        return InternalServerError(
+            "Simulated server error", response=response, body=None
+        )
+
+    def create(self, **request) -> ChatCompletion:
+        time.sleep(self.sample_latency())
+        status = self.sample_error()
+        if status is not None:
+            raise self.error(status)
+        return ChatCompletion.model_validate(self.completion(**request))
+
+    async def acreate(self, **request) -> Any:
+        latency = self.sample_latency()
+        status = self.sample_error()
+        if not request.get("stream"):
+            await asyncio.sleep(latency)
+            if status is not None:
+                raise self.error(status)
+            return ChatCompletion.model_validate(self.completion(**request))
+
+        # Streams pay half the latency before the first token and spread the rest.
+        await asyncio.sleep(latency / 2)
+        if status is not None:
+            raise self.error(status)
+        chunks = self.chunks(self.completion(**request))
+        return self._stream(chunks, latency / 2 / len(chunks))
+
+    @staticmethod
+    async def _stream(
+        chunks: List[Dict[str, Any]], pace: float
+    ) -> AsyncIterator[ChatCompletionChunk]:
+        for chunk in chunks:
+            await asyncio.sleep(pace)
+            yield ChatCompletionChunk.model_validate(chunk)
+
+
+def backend_from_env() -> LLMBackend:
+    """
+    The backend named by PROMPT2PROSE_LLM_BACKEND: "openai" (default) or "fake".
+    PROMPT2PROSE_MODEL picks the default model, PROMPT2PROSE_LLM_BASE_URL points the OpenAI
+    backend at another compatible server, and PROMPT2PROSE_FAKE_* configure the fake.
+    """
+    kind = os.environ.get("PROMPT2PROSE_LLM_BACKEND", "openai")
+    model = DEFAULT_MODEL
+    if kind == "openai":
+        return OpenAIBackend(
+            model=model, base_url=os.environ.get("PROMPT2PROSE_LLM_BASE_URL")
+        )
+    if kind == "fake":
+        return FakeBackend.from_env(model=model)
+    raise ValueError(
+        f"Unknown PROMPT2PROSE_LLM_BACKEND {kind!r}; expected 'openai' or 'fake'."
+    )
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    Iterable,
+    Optional,
+    Set,
+    Union,
+)
+
+from utils.api_utils import BeatConfig, BeatMetadataConfig, StoryResponse
+from utils.story_utils import BeatToStory
+
+Lines = Union[Iterable[str], AsyncIterable[str]]
+
+
+def parse_record(record: Dict[str, Any]) -> BeatConfig:
+    """A record with user_metadata is a BeatMetadataConfig, anything else a BeatConfig."""
+    if "user_metadata" in record:
+        return BeatMetadataConfig(**record)
+    return BeatConfig(**record)
+
+
+async def _aiter(lines: Lines) -> AsyncIterator[str]:
+    if hasattr(lines, "__aiter__"):
+        async for line in lines:
+            yield line
+    else:
+        for line in lines:
+            yield line
+
+
+async def _run_record(
+    template: BeatToStory,
+    index: int,
+    line: str,
+    slots: Optional[asyncio.Semaphore] = None,
+) -> Dict[str, Any]:
+    if slots is not None:
+        async with slots:
+            return await _run_record(template, index, line)
+    result: Dict[str, Any] = {"index": index}
+    try:
+        record = json.loads(line)
+        result["id"] = record.get("id", index)
+        config = parse_record(record)
+        user_metadata = (
+            config.user_metadata.model_dump()
+            if isinstance(config, BeatMetadataConfig)
+            else None
+        )
+
+        start_time = datetime.now()
+        run = template.new_run(
+            beats=config.beats,
+            user_metadata=user_metadata,
+            max_cost=config.max_cost,
+            max_seconds=config.max_seconds,
+            agent_models=config.agent_models,
+            idempotency_key=config.idempotency_key,
+        )
+        await run.apipe()
+        result["response"] = StoryResponse.from_run(
+            run, start_time, config.gen_metadata_flag, config.trace
+        ).model_dump()
+    except Exception as e:
+        result["error"] = f"{e.__class__.__name__}: {e}"
+    return result
+
+
+async def iter_batch_results(
+    template: BeatToStory,
+    lines: Lines,
+    concurrency: int = 4,
+    skip: Set[int] = frozenset(),
+    slots: Optional[asyncio.Semaphore] = None,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Runs JSONL records through the pipeline, yielding results as each one finishes.
+    lines is consumed lazily, so at most `concurrency` records are parsed and in
+    flight at a time. How much input is held in memory is up to lines: a list is
+    held whole, a file or async stream is read as records are started.
+    Arguments:
+    - template: A set-up BeatToStory whose agents every record shares.
+    - lines: JSONL lines (sync or async iterable) of BeatConfig/BeatMetadataConfig records.
+    - concurrency: Records in flight at once.
+    - skip: Record indices to leave out, e.g. those already in a previous output file.
+    - slots: Semaphore shared by concurrent batches to cap the records running across
+      all of them; each record holds a slot while it runs.
+
+    Yields:
+    - {"index", "id", "response"} per record, or {"index", "id", "error"} if it failed.
+    Closing the iterator early cancels the records still in flight.
+    """
+    pending = set()
+    index = -1
+    try:
+        async for line in _aiter(lines):
+            if not line.strip():
+                continue
+            index += 1
+            if index in skip:
+                continue
+            if len(pending) >= concurrency:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+            pending.add(asyncio.create_task(_run_record(template, index, line, slots)))
+
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                yield task.result()
+    finally:
+        # The consumer stopped early (e.g. the client disconnected): stop the
+        # records still running instead of letting them spend on nobody's behalf.
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def completed_indices(output_path: str) -> Set[int]:
+    """
+    Indices that already have a response in output_path.
+    A torn last line from an interrupted run is cut off so appends stay valid JSONL.
+    """
+    if not os.path.exists(output_path):
+        return set()
+
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[: data.rfind(b"\n") + 1]
+
+    done = set()
+    for line in data.decode("utf-8").splitlines():
+        try:
+            result = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if "response" in result:
+            done.add(result["index"])
+    return done
+
+
+async def run_batch(
+    template: BeatToStory, input_path: str, output_path: str, concurrency: int = 4
+) -> Dict[str, int]:
+    """
+    Runs every record in input_path and appends each result to output_path as it finishes.
+    Records already answered in output_path are skipped, so an interrupted batch resumes.
+    """
+    skip = completed_indices(output_path)
+    counts = {"skipped": len(skip), "succeeded": 0, "failed": 0}
+
+    with open(input_path, encoding="utf-8") as lines, open(
+        output_path, "a", encoding="utf-8"
+    ) as out:
+        async for result in iter_batch_results(template, lines, concurrency, skip):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+            counts["failed" if "error" in result else "succeeded"] += 1
+    return counts
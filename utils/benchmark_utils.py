@@ -0,0 +1,182 @@
+import json
+import statistics
+import time
+from typing import Any, Dict, List, Optional
+
+import utils.llm_utils as llm_utils
+from utils.backend_utils import FakeBackend
+from utils.llm_utils import RateLimiter, get_backend, set_backend
+from utils.story_utils import BeatToStory
+
+BENCHMARK_BEAT_COUNTS = [2, 10, 50, 200]
+
+_METADATA = {
+    "setting": {"location": "a research station on the moon", "notes": "low gravity"},
+    "characters": [
+        {"name": "Jack", "profile": "station engineer, calm under pressure"},
+        {"name": "Xander", "profile": "pilot, restless and curious"},
+    ],
+}
+
+# user_metadata per variant: plain beats, then metadata with and without genre/style.
+BENCHMARK_VARIANTS: Dict[str, Optional[Dict[str, Any]]] = {
+    "plain": None,
+    "metadata": _METADATA,
+    "genre": {**_METADATA, "genre": "noir"},
+    "genre_style": {**_METADATA, "genre": "noir", "style": "pirate"},
+}
+
+# Metrics compared against a baseline; higher is worse for each of them.
+COMPARED_METRICS = ["wall_seconds", "llm_calls", "cost", "attempts_per_beat"]
+
+
+def benchmark_beats(count: int) -> List[str]:
+    return [
+        f"Beat {i}: Jack and Xander work through step {i} of the station repair."
+        for i in range(count)
+    ]
+
+
+async def run_scenario(
+    template: BeatToStory,
+    backend: FakeBackend,
+    beat_count: int,
+    variant: str,
+    repeat: int = 1,
+) -> Dict[str, Any]:
+    """
+    Time `repeat` runs of one beat count / metadata variant against backend.
+    Wall time is the median over the repeats; call counts and cost are per run.
+    """
+    name = f"beats={beat_count}/{variant}"
+    walls, costs, calls, prose_calls, errors = [], [], [], [], []
+    passage_seconds, rewrite_seconds = [], []
+    for i in range(repeat):
+        # Each scenario draws its own random stream, so adding one leaves the rest unchanged.
+        backend.reseed(f"{name}/{i}")
+        before = dict(backend.calls)
+        errors_before = backend.errors
+        run = template.new_run(
+            benchmark_beats(beat_count), user_metadata=BENCHMARK_VARIANTS[variant]
+        )
+        start = time.perf_counter()
+        await run.apipe()
+        walls.append(time.perf_counter() - start)
+
+        made = {k: v - before.get(k, 0) for k, v in backend.calls.items()}
+        costs.append(run.pipeline_cost()["total"])
+        calls.append(sum(made.values()))
+        prose_calls.append(made.get("prose", 0))
+        errors.append(backend.errors - errors_before)
+        rewrite = run.generation_metadata.get("rewrite", {})
+        if "mean_passage_seconds" in rewrite:
+            passage_seconds.append(rewrite["mean_passage_seconds"])
+            rewrite_seconds.append(rewrite["mean_rewrite_seconds"])
+
+    passages = max(1, beat_count - 1)
+    return {
+        "name": name,
+        "beats": beat_count,
+        "variant": variant,
+        "repeat": repeat,
+        "wall_seconds": statistics.median(walls),
+        "llm_calls": statistics.mean(calls),
+        "cost": statistics.mean(costs),
+        # Every ProseAgent call is one candidate passage, so this counts retries too.
+        "attempts_per_beat": statistics.mean(prose_calls) / passages,
+        "api_errors": statistics.mean(errors),
+        # Latency of an accepted passage, and the part of it spent on genre/style rewrites.
+        "passage_seconds": (
+            statistics.median(passage_seconds) if passage_seconds else None
+        ),
+        "rewrite_seconds": (
+            statistics.median(rewrite_seconds) if rewrite_seconds else None
+        ),
+    }
+
+
+async def run_benchmark(
+    template: BeatToStory,
+    backend: FakeBackend,
+    beat_counts: List[int] = BENCHMARK_BEAT_COUNTS,
+    variants: Optional[List[str]] = None,
+    repeat: int = 1,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> Dict[str, Any]:
+    """
+    Run every beat count / variant pair through template with backend standing in
+    for the API. The previous backend is restored afterwards.
+    Arguments:
+    - rate_limiter: Limiter to run under. The default has no rpm/tpm caps, so the
+      numbers measure the pipeline rather than the production quota.
+    Returns:
+    - {"config": ..., "results": [one run_scenario() dict per scenario]}
+    """
+    variants = variants or list(BENCHMARK_VARIANTS)
+    previous = get_backend(), llm_utils.rate_limiter
+    set_backend(backend)
+    llm_utils.rate_limiter = rate_limiter or RateLimiter(
+        rpm=float("inf"), tpm=float("inf")
+    )
+    try:
+        results = [
+            await run_scenario(template, backend, count, variant, repeat)
+            for count in beat_counts
+            for variant in variants
+        ]
+    finally:
+        set_backend(previous[0])
+        llm_utils.rate_limiter = previous[1]
+
+    return {
+        "config": {
+            "latency_ms": backend.latency_ms,
+            "latency_sigma": backend.latency_sigma,
+            "error_rate": backend.error_rate,
+            "rejection_rate": backend.rejection_rate,
+            "length_failure_rate": backend.length_failure_rate,
+            "speculative_candidates": template.speculative_candidates,
+            "stream_prose": template.stream_prose,
+            "retry_mode": template.retry_mode,
+            "context_mode": template.context_mode,
+            "context_encoding": template.context_encoding,
+            "edit_mode": template.edit_mode,
+            "agent_models": template.agent_models,
+            "fused_rewrite": template.fused_rewrite,
+            "prefilter_accept_above": template.prefilter_accept_above,
+        },
+        "results": results,
+    }
+
+
+def compare_to_baseline(
+    report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2
+) -> List[str]:
+    """
+    List every metric that got worse than the baseline by more than tolerance
+    (a fraction, 0.2 = 20%), and every baseline scenario missing from report.
+    """
+    current = {result["name"]: result for result in report["results"]}
+    regressions = []
+    for base in baseline["results"]:
+        result = current.get(base["name"])
+        if result is None:
+            regressions.append(f"{base['name']}: missing from this run")
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = base.get(metric), result.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1 + tolerance) and new - old > 1e-9:
+                regressions.append(
+                    f"{base['name']}: {metric} {old:.6g} -> {new:.6g} "
+                    f"(+{(new - old) / old:.0%})"
+                    if old
+                    else f"{base['name']}: {metric} 0 -> {new:.6g}"
+                )
+    return regressions
+
+
+def load_report(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
@@ -0,0 +1,77 @@
+import time
+from typing import Any, Dict, Optional
+
+
+class BudgetExceededError(Exception):
+    """Raised before an LLM call that the run's Budget cannot afford."""
+
+
+class Budget:
+    """
+    Cost and wall-clock ceiling for one BeatToStory run.
+    Every chat call reserves its worst-case cost (prompt tokens counted locally plus
+    max_tokens of completion) before it is sent, and settles to the real cost after.
+    A call that would push spent + reserved past max_cost, or that starts after
+    max_seconds, is refused with BudgetExceededError.
+    Attributes:
+        max_cost (float): Dollar ceiling for the run, None for no ceiling.
+        max_seconds (float): Wall-clock budget for the run, None for no limit.
+    """
+
+    def __init__(
+        self, max_cost: Optional[float] = None, max_seconds: Optional[float] = None
+    ):
+        self.max_cost = max_cost
+        self.max_seconds = max_seconds
+        self.spent = 0.0
+        self.reserved = 0.0
+        self.refused_calls = 0
+        self.skipped_stages: Dict[str, int] = {}
+        self._started = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self._started
+
+    @property
+    def exhausted(self) -> bool:
+        return self.refused_calls > 0
+
+    def reserve(self, worst_case_cost: float) -> float:
+        """Hold worst_case_cost for a call about to be sent, or refuse it."""
+        if self.max_seconds is not None and self.elapsed > self.max_seconds:
+            self.refused_calls += 1
+            raise BudgetExceededError(
+                f"Time budget of {self.max_seconds}s used up after {self.elapsed:.1f}s."
+            )
+        if (
+            self.max_cost is not None
+            and self.spent + self.reserved + worst_case_cost > self.max_cost
+        ):
+            self.refused_calls += 1
+            raise BudgetExceededError(
+                f"Cost budget of ${self.max_cost} would be exceeded: "
+                f"${self.spent:.6f} spent, ${self.reserved:.6f} in flight, "
+                f"next call up to ${worst_case_cost:.6f}."
+            )
+        self.reserved += worst_case_cost
+        return worst_case_cost
+
+    def settle(self, reserved: float, cost: float) -> None:
+        """Release a reservation and charge what the call actually cost."""
+        self.reserved -= reserved
+        self.spent += cost
+
+    def skip(self, stage: str) -> None:
+        """Record an optional stage that was dropped to stay within budget."""
+        self.skipped_stages[stage] = self.skipped_stages.get(stage, 0) + 1
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "spent": self.spent,
+            "max_cost": self.max_cost,
+            "elapsed": self.elapsed,
+            "max_seconds": self.max_seconds,
+            "refused_calls": self.refused_calls,
+            "skipped_stages": dict(self.skipped_stages),
+        }
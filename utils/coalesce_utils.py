@@ -0,0 +1,97 @@
+import asyncio
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+
+class RequestCoalescer:
+    """
+    Single-flight execution of identical requests.
+    Requests are keyed on a canonical hash of their payload. The first request for a
+    key runs; concurrent duplicates wait on the same run and get its result. A
+    finished result is kept for window_seconds, so late retries of a request that
+    just completed get it too. Failures are shared with the requests waiting on the
+    run, but never kept: the next request for the key runs again.
+    Attributes:
+        window_seconds (float): How long a completed result is served to repeats, 0 disables it.
+        max_completed (int): Completed results kept, oldest evicted first.
+    """
+
+    def __init__(self, window_seconds: float = 30.0, max_completed: int = 256):
+        self.window_seconds = window_seconds
+        self.max_completed = max_completed
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._completed: "OrderedDict[str, tuple]" = OrderedDict()
+        self._stats = {"runs": 0, "coalesced": 0, "window_hits": 0, "errors": 0}
+
+    @staticmethod
+    def make_key(kind: str, payload: Dict[str, Any]) -> str:
+        """Hash a request kind (e.g. the endpoint) and its payload, independent of key order."""
+        canonical = json.dumps(
+            {"kind": kind, "payload": payload},
+            sort_keys=True,
+            separators=(",", ":"),
+            ensure_ascii=False,
+            default=str,
+        )
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _cached(self, key: str) -> Optional[tuple]:
+        entry = self._completed.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[1] > self.window_seconds:
+            del self._completed[key]
+            return None
+        return entry
+
+    async def run(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Result of factory() for key, running it only if no identical request is in
+        flight or finished within the window. The run is a task of its own, so a
+        cancelled caller does not cancel it for the others waiting on it.
+        """
+        entry = self._cached(key)
+        if entry is not None:
+            self._stats["window_hits"] += 1
+            return entry[0]
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            self._stats["coalesced"] += 1
+            return await asyncio.shield(future)
+
+        self._stats["runs"] += 1
+        future = asyncio.ensure_future(factory())
+        self._in_flight[key] = future
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return await asyncio.shield(future)
+
+    def _finish(self, key: str, future: asyncio.Future) -> None:
+        self._in_flight.pop(key, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self._stats["errors"] += 1
+            return
+        if self.window_seconds > 0:
+            self._completed[key] = (future.result(), time.monotonic())
+            self._completed.move_to_end(key)
+            while len(self._completed) > self.max_completed:
+                self._completed.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        runs: pipelines actually run; coalesced: requests that attached to a run in
+        flight; window_hits: requests served a result completed within the window.
+        """
+        requests = sum(self._stats[k] for k in ("runs", "coalesced", "window_hits"))
+        return {
+            **self._stats,
+            "requests": requests,
+            "in_flight": len(self._in_flight),
+            "completed": len(self._completed),
+            "saved_runs": requests - self._stats["runs"],
+        }
@@ -0,0 +1,135 @@
+import json
+from typing import Any, Dict, List, Optional
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or value == "" or value == [] or value == {}
+
+
+def drop_empty(value: Any) -> Any:
+    """value with None, empty strings, lists and dicts removed at every level."""
+    if isinstance(value, dict):
+        cleaned = {key: drop_empty(item) for key, item in value.items()}
+        return {key: item for key, item in cleaned.items() if not _is_empty(item)}
+    if isinstance(value, list):
+        cleaned = [drop_empty(item) for item in value]
+        return [item for item in cleaned if not _is_empty(item)]
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def compact_json(value: Any) -> str:
+    """value as JSON without empty values or whitespace between tokens."""
+    return json.dumps(drop_empty(value), separators=(",", ":"), ensure_ascii=False)
+
+
+def _same(a: Any, b: Any) -> bool:
+    return " ".join(str(a or "").lower().split()) == " ".join(
+        str(b or "").lower().split()
+    )
+
+
+def _character_line(character: Dict[str, Any], before: Optional[Dict[str, Any]]) -> str:
+    """'Name (on stage, changed; profile)' with the profile left out when repeated."""
+    name = str(character.get("name") or "?").strip()
+    details = [str(character.get("character_location") or "").strip()]
+    if character.get("status_change"):
+        details.append("changed")
+    extra = {
+        key: value
+        for key, value in drop_empty(character).items()
+        if key not in ("name", "character_location", "status_change")
+    }
+    if before is not None:
+        extra = {
+            key: value
+            for key, value in extra.items()
+            if not _same(value, before.get(key))
+        }
+    text = ", ".join(detail for detail in details if detail)
+    if extra:
+        profile = "; ".join(
+            value if isinstance(value, str) else compact_json(value)
+            for value in extra.values()
+        )
+        text = f"{text}; {profile}" if text else profile
+    return f"{name} ({text})" if text else name
+
+
+def encode_context(context: Any, previous: Any = None, mode: str = "compact") -> str:
+    """
+    Serialize a beat's scene context for a prompt.
+    Arguments:
+    - context: The ContextAgent dict (setting, characters), optionally enriched by MetadataAgent.
+    - previous: The previous beat's context, used by mode="delta".
+    - mode:
+        "raw": str(context), the Python repr the prompts used to carry.
+        "compact": one line per field, names instead of keys, empty values and false
+          change flags dropped. Nothing with content is left out.
+        "delta": like compact, but setting notes and details, and character profiles,
+          are only sent when they differ from the previous beat (or the location changed). The prompt already
+          carries the previous passage, which reflects them. The location and the
+          characters present are always sent.
+    Returns:
+    - The encoded context. Contexts that are not dicts are passed through as strings.
+    """
+    if mode == "raw" or not isinstance(context, dict):
+        return str(context)
+    if mode != "delta" or not isinstance(previous, dict):
+        previous = None
+
+    setting = context.get("setting") if isinstance(context.get("setting"), dict) else {}
+    before = (previous or {}).get("setting") or {}
+    lines: List[str] = []
+
+    location = str(setting.get("location") or "").strip()
+    if location:
+        changed = " (changed)" if setting.get("location_change") else ""
+        lines.append(f"Location: {location}{changed}")
+    labels = {"notes": "Notes", "important_details": "Details"}
+    for key, value in drop_empty(setting).items():
+        if key in ("location", "location_change"):
+            continue
+        if (
+            previous is not None
+            and not setting.get("location_change")
+            and _same(value, before.get(key))
+        ):
+            continue
+        lines.append(
+            f"{labels.get(key, key)}: {value if isinstance(value, str) else compact_json(value)}"
+        )
+
+    previous_characters = {
+        str(character.get("name") or "").lower(): character
+        for character in (previous or {}).get("characters") or []
+        if isinstance(character, dict)
+    }
+    characters = [
+        _character_line(
+            character,
+            (
+                None
+                if previous is None or character.get("status_change")
+                else previous_characters.get(str(character.get("name") or "").lower())
+            ),
+        )
+        for character in context.get("characters") or []
+        if isinstance(character, dict)
+    ]
+    if characters:
+        lines.append(f"Characters: {', '.join(characters)}")
+
+    others = {
+        key: value
+        for key, value in context.items()
+        if key not in ("setting", "characters")
+    }
+    for key, value in drop_empty(others).items():
+        lines.append(
+            f"{key}: {value if isinstance(value, str) else compact_json(value)}"
+        )
+    if previous is not None:
+        lines.append("Anything not listed is unchanged from the previous passage.")
+    return "\n".join(lines)
@@ -0,0 +1,189 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# A job runner gets (kind, payload, report) and returns the JSON-able result;
+# report(progress) merges stage progress into the job record.
+JobRunner = Callable[
+    [str, Dict[str, Any], Callable[[Dict[str, Any]], None]], Awaitable[Dict[str, Any]]
+]
+
+
+class QueueFullError(Exception):
+    """Raised by JobQueue.submit when max_queue_depth jobs are already waiting."""
+
+
+class JobStore:
+    """
+    SQLite-backed record of submitted jobs.
+    Payloads are stored with the job, so queued work survives a restart.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                progress TEXT NOT NULL,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)"
+        )
+        self._conn.commit()
+
+    def create(self, kind: str, payload: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs VALUES (?, ?, ?, 'queued', '{}', NULL, NULL, ?, ?)",
+                (job_id, kind, json.dumps(payload), now, now),
+            )
+            self._conn.commit()
+        return job_id
+
+    def update(self, job_id: str, **fields) -> None:
+        """Set any of status, progress, result, error on a job."""
+        for key in ("progress", "result"):
+            if key in fields and fields[key] is not None:
+                fields[key] = json.dumps(fields[key])
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET {columns} WHERE job_id = ?",
+                (*fields.values(), job_id),
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT * FROM jobs WHERE job_id = ?", (job_id,)
+            )
+            row = cursor.fetchone()
+            names = [column[0] for column in cursor.description]
+        if row is None:
+            return None
+        job = dict(zip(names, row))
+        for key in ("payload", "progress", "result"):
+            if job[key] is not None:
+                job[key] = json.loads(job[key])
+        return job
+
+    def ids_with_status(self, *statuses: str) -> List[str]:
+        placeholders = ", ".join("?" for _ in statuses)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT job_id FROM jobs WHERE status IN ({placeholders}) ORDER BY created_at",
+                statuses,
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def purge_finished(self, max_age_seconds: float) -> int:
+        """Delete finished jobs last updated more than max_age_seconds ago."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (time.time() - max_age_seconds,),
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+
+class JobQueue:
+    """
+    Bounded in-process worker pool over a JobStore.
+    Attributes:
+        max_workers (int): Jobs run concurrently.
+        max_queue_depth (int): Jobs allowed to wait; submit raises QueueFullError beyond it.
+    """
+
+    def __init__(
+        self,
+        store: JobStore,
+        runner: JobRunner,
+        max_workers: int = 4,
+        max_queue_depth: int = 100,
+    ):
+        self.store = store
+        self.runner = runner
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+
+    async def start(self) -> None:
+        """Start the workers and re-queue jobs a previous process left unfinished."""
+        self._queue = asyncio.Queue()
+        for job_id in self.store.ids_with_status("running", "queued"):
+            self.store.update(job_id, status="queued")
+            self._queue.put_nowait(job_id)
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.max_workers)
+        ]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def submit(self, kind: str, payload: Dict[str, Any]) -> str:
+        if self._queue is None:
+            raise RuntimeError("JobQueue.start() has not been awaited.")
+        if self.depth >= self.max_queue_depth:
+            raise QueueFullError(
+                f"{self.depth} jobs already queued (limit {self.max_queue_depth})."
+            )
+        job_id = self.store.create(kind, payload)
+        self._queue.put_nowait(job_id)
+        return job_id
+
+    async def _worker(self) -> None:
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id: str) -> None:
+        job = self.store.get(job_id)
+        if job is None:
+            return
+        progress = dict(job["progress"])
+        self.store.update(job_id, status="running")
+
+        def report(update: Dict[str, Any]) -> None:
+            progress.update(update)
+            self.store.update(job_id, progress=progress)
+
+        try:
+            result = await self.runner(job["kind"], job["payload"], report)
+        except asyncio.CancelledError:
+            # Shutting down; leave the job to be re-queued on the next start().
+            self.store.update(job_id, status="queued")
+            raise
+        except Exception as e:
+            self.store.update(job_id, status="failed", error=str(e))
+        else:
+            self.store.update(job_id, status="done", result=result)
@@ -1,27 +1,586 @@
+import asyncio
 import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
-from openai import OpenAI
+from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
 
-client = OpenAI(api_key=os.environ.get("OPENAI_KEY"))
+from utils.backend_utils import DEFAULT_MODEL, LLMBackend, backend_from_env
+from utils.budget_utils import Budget
+from utils.model_utils import model_spec
+
+try:
+    import tiktoken
+except ImportError:  # fall back to the character heuristic in count_prompt_tokens
+    tiktoken = None
+
+# Where completions come from; built from the environment on first use.
+_backend: Optional[LLMBackend] = None
+
+# Budget of the run the current context belongs to, set by use_budget().
+_budget_scope: ContextVar[Optional[Budget]] = ContextVar("budget_scope", default=None)
+_encoding = None
+
+# Usage collected by the innermost track_usage() block of the current context.
+_usage_scope: ContextVar[Optional[Dict[str, Any]]] = ContextVar(
+    "usage_scope", default=None
+)
+
+
+@contextmanager
+def track_usage():
+    """
+    Collects cost and token usage of every chat_with_gpt call made inside the block.
+    Agents are shared between runs, so this is how a run attributes spend to itself.
+    """
+    usage = {
+        "cost": 0.0,
+        "calls": 0,
+        "cache_hits": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cached_tokens": 0,
+    }
+    token = _usage_scope.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage_scope.reset(token)
+
+
+def _record_usage(
+    cost, prompt_tokens=0, completion_tokens=0, cached_tokens=0, cache_hit=False
+):
+    usage = _usage_scope.get()
+    if usage is None:
+        return
+    usage["cost"] += cost
+    usage["calls"] += 1
+    usage["cache_hits"] += int(cache_hit)
+    usage["prompt_tokens"] += prompt_tokens
+    usage["completion_tokens"] += completion_tokens
+    usage["cached_tokens"] += cached_tokens
+
+
+def _usage_cost(usage, input_cost, output_cost, cached_input_cost):
+    """
+    Cost of an API usage record, with prompt-cached tokens at cached_input_cost.
+    Returns (cost, prompt_tokens, completion_tokens, cached_tokens).
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = (getattr(details, "cached_tokens", None) or 0) if details else 0
+    cost = (
+        (usage.prompt_tokens - cached_tokens) * input_cost
+        + cached_tokens * cached_input_cost
+        + usage.completion_tokens * output_cost
+    )
+    return cost, usage.prompt_tokens, usage.completion_tokens, cached_tokens
+
+
+@contextmanager
+def use_budget(budget: Optional[Budget]):
+    """Enforce budget on every chat call made inside the block (and its tasks)."""
+    token = _budget_scope.set(budget)
+    try:
+        yield budget
+    finally:
+        _budget_scope.reset(token)
+
+
+def count_tokens(text: str) -> int:
+    """
+    Tokens of text, counted locally with tiktoken when it is installed,
+    otherwise estimated at ~4 characters per token.
+    """
+    global _encoding
+    if tiktoken is not None and _encoding is None:
+        try:
+            _encoding = tiktoken.encoding_for_model(DEFAULT_MODEL)
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(text) // 4
+
+
+def count_prompt_tokens(messages: List[Dict[str, str]]) -> int:
+    """Prompt tokens of a call (see count_tokens), plus a few tokens of framing per message."""
+    contents = [message.get("content") or "" for message in messages]
+    return sum(count_tokens(text) for text in contents) + 4 * len(contents)
+
+
+def estimate_tokens(messages: List[Dict[str, str]], max_tokens: int = 0) -> int:
+    """Worst-case token count of a call: its prompt plus the full completion allowance."""
+    return count_prompt_tokens(messages) + max_tokens
+
+
+def fits_context_window(
+    model: Optional[str], messages: List[Dict[str, str]], max_tokens: int = 0
+) -> bool:
+    """Whether a call's prompt plus its completion allowance fits the model's context window."""
+    spec = model_spec(model or get_backend().model)
+    return estimate_tokens(messages, max_tokens) <= spec.context_window
+
+
+def _reserve_budget(messages, max_tokens, input_cost, output_cost):
+    """
+    Reserve a call's worst-case cost on the current budget; raises if it cannot pay.
+    Returns (budget, reserved) for _settle_budget.
+    """
+    budget = _budget_scope.get()
+    if budget is None:
+        return None, 0.0
+    worst_case = count_prompt_tokens(messages) * input_cost + max_tokens * output_cost
+    return budget, budget.reserve(worst_case)
+
+
+def _settle_budget(budget: Optional[Budget], reserved: float, cost: float) -> None:
+    if budget is not None:
+        budget.settle(reserved, cost)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds the provider asked us to wait, from retry-after(-ms) headers."""
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (RateLimitError, APITimeoutError, APIConnectionError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
+
+class RateLimiter:
+    """
+    Process-wide client-side limiter in front of the chat completion API.
+    - Token buckets for requests and tokens per minute; a call waits until both have room.
+    - AIMD concurrency for async calls: the in-flight limit halves on a 429 and grows
+      back by about one slot per window of successful calls.
+    - Retries of 429s, timeouts and 5xx errors with jittered exponential backoff that
+      never waits less than the provider's retry-after.
+    Attributes:
+        rpm (float): Requests per minute.
+        tpm (float): Tokens per minute, charged with estimate_tokens() before each call.
+        max_concurrency (int): Upper bound of the AIMD in-flight limit.
+        max_retries (int): Retries per call before the error is raised.
+    """
+
+    def __init__(
+        self,
+        rpm: float = 3500,
+        tpm: float = 90_000,
+        max_concurrency: int = 64,
+        min_concurrency: int = 1,
+        max_retries: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+    ):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.concurrency = float(max_concurrency)
+        self._lock = threading.Lock()
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._refilled = time.monotonic()
+        self._last_decrease = 0.0
+        self._in_flight = 0
+        self._waiters: deque = deque()
+        self._metrics = {
+            "calls": 0,
+            "retries": 0,
+            "rate_limited": 0,
+            "errors": 0,
+            "queue_wait_total": 0.0,
+            "queue_wait_max": 0.0,
+        }
+
+    def _reserve(self, tokens: int) -> float:
+        """Take capacity from both buckets, or return how long to wait for it."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._refilled
+            self._refilled = now
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+            # A call bigger than the whole bucket only needs a full bucket.
+            tokens = min(tokens, self.tpm)
+            if self._requests >= 1 and self._tokens >= tokens:
+                self._requests -= 1
+                self._tokens -= tokens
+                return 0.0
+            return max(
+                (1 - self._requests) * 60 / self.rpm,
+                (tokens - self._tokens) * 60 / self.tpm,
+                0.001,
+            )
+
+    async def _enter(self) -> None:
+        while True:
+            with self._lock:
+                if self._in_flight < int(self.concurrency):
+                    self._in_flight += 1
+                    return
+                waiter = asyncio.get_running_loop().create_future()
+                self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Hand a wake-up we can no longer use to the next waiter.
+                with self._lock:
+                    self._wake_waiters()
+                raise
+
+    def _exit(self, rate_limited: bool) -> None:
+        with self._lock:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if rate_limited:
+                # Halve at most once per second so one burst of 429s counts once.
+                if now - self._last_decrease > 1.0:
+                    self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                    self._last_decrease = now
+            else:
+                self.concurrency = min(
+                    self.max_concurrency, self.concurrency + 1 / self.concurrency
+                )
+            self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        """Wake as many waiters as there are free slots; the lock must be held."""
+        free = int(self.concurrency) - self._in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+                free -= 1
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        retry_after = _retry_after(error)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    def _record_wait(self, waited: float) -> None:
+        with self._lock:
+            self._metrics["calls"] += 1
+            self._metrics["queue_wait_total"] += waited
+            self._metrics["queue_wait_max"] = max(
+                self._metrics["queue_wait_max"], waited
+            )
+
+    def _record_error(self, error: Exception, retrying: bool) -> None:
+        with self._lock:
+            self._metrics["rate_limited"] += isinstance(error, RateLimitError)
+            self._metrics["retries" if retrying else "errors"] += 1
+
+    async def arun(self, call: Callable[[], Awaitable[Any]], tokens: int) -> Any:
+        """Await call() once there is capacity, retrying transient failures."""
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            await self._enter()
+            rate_limited = False
+            try:
+                while (delay := self._reserve(tokens)) > 0:
+                    await asyncio.sleep(delay)
+                self._record_wait(time.monotonic() - start)
+                return await call()
+            except Exception as e:
+                rate_limited = isinstance(e, RateLimitError)
+                retrying = _is_retryable(e) and attempt < self.max_retries
+                self._record_error(e, retrying)
+                if not retrying:
+                    raise
+                backoff = self._backoff(attempt, e)
+            finally:
+                self._exit(rate_limited)
+            await asyncio.sleep(backoff)
+
+    def run(self, call: Callable[[], Any], tokens: int) -> Any:
+        """Sync version of arun; rate limited by the buckets, without the AIMD gate."""
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            while (delay := self._reserve(tokens)) > 0:
+                time.sleep(delay)
+            self._record_wait(time.monotonic() - start)
+
+            try:
+                return call()
+            except Exception as e:
+                retrying = _is_retryable(e) and attempt < self.max_retries
+                self._record_error(e, retrying)
+                if not retrying:
+                    raise
+                time.sleep(self._backoff(attempt, e))
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = dict(self._metrics)
+            metrics["queue_wait_avg"] = (
+                metrics["queue_wait_total"] / metrics["calls"]
+                if metrics["calls"]
+                else 0.0
+            )
+            metrics["concurrency_limit"] = int(self.concurrency)
+            metrics["in_flight"] = self._in_flight
+            metrics["waiting"] = len(self._waiters)
+        return metrics
+
+
+def _wake(waiter: asyncio.Future) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+rate_limiter = RateLimiter(
+    rpm=float(os.environ.get("PROMPT2PROSE_RPM", 3500)),
+    tpm=float(os.environ.get("PROMPT2PROSE_TPM", 90_000)),
+    max_concurrency=int(os.environ.get("PROMPT2PROSE_MAX_CONCURRENCY", 64)),
+)
+
+
+def get_backend() -> LLMBackend:
+    """Return the LLM backend, creating it from PROMPT2PROSE_LLM_BACKEND on first use."""
+    global _backend
+    if _backend is None:
+        _backend = backend_from_env()
+    return _backend
+
+
+def set_backend(backend: LLMBackend) -> None:
+    """Send every following chat call to backend, e.g. a FakeBackend for offline runs."""
+    global _backend
+    _backend = backend
+
+
+def _resolve_model(
+    model, messages, max_tokens, input_cost, output_cost, cached_input_cost
+):
+    """
+    Model and per-token prices (input, output, cached input) of a call: the named model
+    (or the backend's default) priced from the model registry unless prices are passed
+    explicitly. An explicit input_cost without a cached_input_cost keeps the model's
+    cached-to-uncached price ratio.
+    Raises ValueError if the prompt and completion cannot fit the model's context window.
+    """
+    spec = model_spec(model or get_backend().model)
+    if not fits_context_window(spec.name, messages, max_tokens):
+        raise ValueError(
+            f"Call needs ~{estimate_tokens(messages, max_tokens)} tokens but {spec.name} "
+            f"has a {spec.context_window} token context window."
+        )
+    if cached_input_cost is None:
+        cached_input_cost = spec.cached_input_cost
+        if input_cost is not None and spec.input_cost:
+            cached_input_cost *= input_cost / spec.input_cost
+    return (
+        spec.name,
+        spec.input_cost if input_cost is None else input_cost,
+        spec.output_cost if output_cost is None else output_cost,
+        cached_input_cost,
+    )
+
+
+def _cache_lookup(cache, model, messages, max_tokens, temperature):
+    """Return (key, cached response) for a cacheable call, recording hits as free."""
+    if cache is None:
+        return None, None
+    key = cache.make_key(model, messages, temperature, max_tokens)
+    cached = cache.get(key)
+    if cached is not None:
+        _record_usage(0.0, cache_hit=True)
+    return key, cached
+
+
+def _completion_result(
+    completion, input_cost, output_cost, cached_input_cost, cache=None, key=None
+):
+    cost, *tokens = _usage_cost(
+        completion.usage, input_cost, output_cost, cached_input_cost
+    )
+    _record_usage(cost, *tokens)
+    response_text = completion.choices[0].message.content.strip()
+    if cache is not None:
+        cache.set(key, response_text)
+    return response_text, cost
 
 
 def chat_with_gpt(
     messages,
     max_tokens=400,
     temperature=0.3,
-    input_cost=0.5 / 1e6,
-    output_cost=1.5 / 1e6,
+    model=None,
+    input_cost=None,
+    output_cost=None,
+    cached_input_cost=None,
+    cache=None,
 ):
-    """Calls the OpenAI Chat Completion API with the provided messages."""
-    completion = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=messages,
-        max_tokens=max_tokens,
-        temperature=temperature,
+    """
+    Calls the chat completion API of the configured backend (see get_backend) with the provided messages.
+    model defaults to the backend's model; the call is priced from the model registry
+    unless input_cost/output_cost/cached_input_cost (dollars per token) are given.
+    If a ResponseCache is given, identical requests are served from it at zero cost.
+    """
+    model, input_cost, output_cost, cached_input_cost = _resolve_model(
+        model, messages, max_tokens, input_cost, output_cost, cached_input_cost
     )
+    key, cached = _cache_lookup(cache, model, messages, max_tokens, temperature)
+    if cached is not None:
+        return cached, 0.0
 
-    cost = (
-        completion.usage.prompt_tokens * input_cost
-        + completion.usage.completion_tokens * output_cost
+    budget, reserved = _reserve_budget(messages, max_tokens, input_cost, output_cost)
+    cost = 0.0
+    try:
+        backend = get_backend()
+        completion = rate_limiter.run(
+            lambda: backend.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+            ),
+            estimate_tokens(messages, max_tokens),
+        )
+        response_text, cost = _completion_result(
+            completion, input_cost, output_cost, cached_input_cost, cache, key
+        )
+    finally:
+        _settle_budget(budget, reserved, cost)
+    return response_text, cost
+
+
+async def achat_with_gpt(
+    messages,
+    max_tokens=400,
+    temperature=0.3,
+    model=None,
+    input_cost=None,
+    output_cost=None,
+    cached_input_cost=None,
+    cache=None,
+):
+    """Async version of chat_with_gpt; awaits the API without blocking the event loop."""
+    model, input_cost, output_cost, cached_input_cost = _resolve_model(
+        model, messages, max_tokens, input_cost, output_cost, cached_input_cost
+    )
+    key, cached = _cache_lookup(cache, model, messages, max_tokens, temperature)
+    if cached is not None:
+        return cached, 0.0
+
+    budget, reserved = _reserve_budget(messages, max_tokens, input_cost, output_cost)
+    cost = 0.0
+    try:
+        backend = get_backend()
+        completion = await rate_limiter.arun(
+            lambda: backend.acreate(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+            ),
+            estimate_tokens(messages, max_tokens),
+        )
+        response_text, cost = _completion_result(
+            completion, input_cost, output_cost, cached_input_cost, cache, key
+        )
+    finally:
+        _settle_budget(budget, reserved, cost)
+    return response_text, cost
+
+
+def _local_cost(messages, text: List[str], input_cost, output_cost):
+    """
+    Cost of a streamed call counted locally from its prompt and the text streamed so
+    far, for when the provider reports no usage. Returns (cost, prompt_tokens,
+    completion_tokens).
+    """
+    prompt_tokens = count_prompt_tokens(messages)
+    completion_tokens = count_tokens("".join(text))
+    cost = prompt_tokens * input_cost + completion_tokens * output_cost
+    return cost, prompt_tokens, completion_tokens
+
+
+async def astream_chat_with_gpt(
+    messages,
+    max_tokens=400,
+    temperature=0.3,
+    model=None,
+    input_cost=None,
+    output_cost=None,
+    cached_input_cost=None,
+):
+    """
+    Streams a chat completion, yielding (text_delta, cost) pairs as tokens arrive.
+    Cost is 0.0 on every pair except the last one, which carries the cost of the call.
+    Closing the generator early (e.g. with contextlib.aclosing) closes the stream, so
+    the provider stops generating; the tokens generated until then are counted locally
+    and billed as the call's cost. A stream that ends without a usage chunk is
+    billed the same way.
+    """
+    model, input_cost, output_cost, cached_input_cost = _resolve_model(
+        model, messages, max_tokens, input_cost, output_cost, cached_input_cost
     )
-    return completion.choices[0].message.content.strip(), cost
+    budget, reserved = _reserve_budget(messages, max_tokens, input_cost, output_cost)
+    cost = 0.0
+    stream = None
+    text = []
+    finished = False
+    try:
+        backend = get_backend()
+        stream = await rate_limiter.arun(
+            lambda: backend.acreate(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+            ),
+            estimate_tokens(messages, max_tokens),
+        )
+        tokens = None
+        async for chunk in stream:
+            if chunk.usage is not None:
+                cost, *tokens = _usage_cost(
+                    chunk.usage, input_cost, output_cost, cached_input_cost
+                )
+            if chunk.choices and chunk.choices[0].delta.content:
+                text.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content, 0.0
+
+        if tokens is None:
+            # Servers that ignore stream_options.include_usage send no usage chunk.
+            cost, *tokens = _local_cost(messages, text, input_cost, output_cost)
+        _record_usage(cost, *tokens)
+        finished = True
+    finally:
+        if stream is not None and not finished:
+            # Abandoned mid-stream: no usage chunk will come, so bill what was generated.
+            cost, *tokens = _local_cost(messages, text, input_cost, output_cost)
+            _record_usage(cost, *tokens)
+            close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+            if close is not None:
+                await close()
+        _settle_budget(budget, reserved, cost)
+    yield "", cost
@@ -0,0 +1,141 @@
+from typing import Dict, Literal, Optional
+
+from pydantic import BaseModel, model_validator
+
+from utils.backend_utils import DEFAULT_MODEL
+
+LatencyClass = Literal["fast", "standard", "slow"]
+
+
+class ModelSpec(BaseModel):
+    """
+    What the pipeline needs to know about a chat model to route and price calls to it.
+    Attributes:
+        name (str): Model name sent to the backend.
+        input_cost (float): Dollars per prompt token.
+        output_cost (float): Dollars per completion token.
+        cached_input_cost (float): Dollars per prompt token served from the provider's
+            prompt cache; defaults to half of input_cost.
+        context_window (int): Prompt plus completion tokens the model accepts.
+        latency_class (str): "fast", "standard" or "slow"; usable as a route in
+            place of a model name, see resolve_model().
+    """
+
+    name: str
+    input_cost: float = 0.5 / 1e6
+    output_cost: float = 1.5 / 1e6
+    cached_input_cost: Optional[float] = None
+    context_window: int = 16_385
+    latency_class: LatencyClass = "standard"
+
+    @model_validator(mode="after")
+    def default_cached_input_cost(self) -> "ModelSpec":
+        if self.cached_input_cost is None:
+            self.cached_input_cost = self.input_cost / 2
+        return self
+
+
+MODEL_REGISTRY: Dict[str, ModelSpec] = {
+    spec.name: spec
+    for spec in [
+        ModelSpec(
+            name="gpt-3.5-turbo",
+            input_cost=0.5 / 1e6,
+            output_cost=1.5 / 1e6,
+            context_window=16_385,
+            latency_class="standard",
+        ),
+        ModelSpec(
+            name="gpt-4o-mini",
+            input_cost=0.15 / 1e6,
+            output_cost=0.6 / 1e6,
+            cached_input_cost=0.075 / 1e6,
+            context_window=128_000,
+            latency_class="fast",
+        ),
+        ModelSpec(
+            name="gpt-4o",
+            input_cost=2.5 / 1e6,
+            output_cost=10.0 / 1e6,
+            cached_input_cost=1.25 / 1e6,
+            context_window=128_000,
+            latency_class="standard",
+        ),
+        ModelSpec(
+            name="gpt-4.1-nano",
+            input_cost=0.1 / 1e6,
+            output_cost=0.4 / 1e6,
+            cached_input_cost=0.025 / 1e6,
+            context_window=1_047_576,
+            latency_class="fast",
+        ),
+        ModelSpec(
+            name="gpt-4.1-mini",
+            input_cost=0.4 / 1e6,
+            output_cost=1.6 / 1e6,
+            cached_input_cost=0.1 / 1e6,
+            context_window=1_047_576,
+            latency_class="fast",
+        ),
+        ModelSpec(
+            name="gpt-4.1",
+            input_cost=2.0 / 1e6,
+            output_cost=8.0 / 1e6,
+            cached_input_cost=0.5 / 1e6,
+            context_window=1_047_576,
+            latency_class="standard",
+        ),
+    ]
+}
+
+
+def register_model(spec: ModelSpec) -> ModelSpec:
+    """Add or replace a model, e.g. a self-hosted one behind PROMPT2PROSE_LLM_BASE_URL."""
+    MODEL_REGISTRY[spec.name] = spec
+    return spec
+
+
+def model_spec(name: Optional[str]) -> ModelSpec:
+    """
+    Registry entry of a model. Unregistered models (e.g. PROMPT2PROSE_MODEL naming a
+    local model) are priced like the default gpt-3.5-turbo entry until registered.
+    """
+    name = name or DEFAULT_MODEL
+    if name in MODEL_REGISTRY:
+        return MODEL_REGISTRY[name]
+    return ModelSpec(name=name)
+
+
+def resolve_model(route: str) -> str:
+    """
+    Model name for a route: a registered model name, or a latency class ("fast",
+    "standard", "slow"), which picks the cheapest registered model of that class.
+    Raises ValueError for anything else.
+    """
+    if route in MODEL_REGISTRY:
+        return route
+    candidates = [
+        spec for spec in MODEL_REGISTRY.values() if spec.latency_class == route
+    ]
+    if not candidates:
+        raise ValueError(
+            f"Unknown model {route!r}; expected one of {sorted(MODEL_REGISTRY)} "
+            "or a latency class (fast, standard, slow)."
+        )
+    return min(candidates, key=lambda spec: spec.input_cost + spec.output_cost).name
+
+
+def parse_agent_models(value: Optional[str]) -> Dict[str, str]:
+    """
+    Parse agent routes written as "story=fast,context=fast,prose=gpt-4o" (the
+    PROMPT2PROSE_AGENT_MODELS format) into {"story": "fast", ...}.
+    """
+    routes = {}
+    for item in (value or "").split(","):
+        if not item.strip():
+            continue
+        agent, sep, model = item.partition("=")
+        if not sep or not agent.strip() or not model.strip():
+            raise ValueError(f"Expected agent=model, got {item.strip()!r}.")
+        routes[agent.strip()] = model.strip()
+    return routes
@@ -0,0 +1,143 @@
+import json
+import re
+import zlib
+from typing import Any, Dict, List, Optional, Set, Union
+
+import numpy as np
+
+# Dimensions of the hashed bag-of-words vectors.
+HASH_DIMS = 4096
+
+_WORD = re.compile(r"[A-Za-z][A-Za-z'\-]*")
+
+_STOPWORDS = frozenset(
+    """a about after again against all an and any are as at be because been before
+    being between both but by can could did do does doing down during each few for
+    from further had has have having he her here hers him his how i if in into is it
+    its just me more most my no nor not now of off on once only or other our out over
+    own same she should so some such than that the their them then there these they
+    this those through to too under until up very was we were what when where which
+    while who whom why will with would you your""".split()
+)
+
+
+class ScoredVerdict(str):
+    """
+    A validator verdict ("True", "False" or "Unsure") that also carries the score it
+    was decided on, so ValidationChain can bucket agreement by score.
+    """
+
+    score: Optional[float] = None
+
+    def __new__(cls, verdict: str, score: Optional[float] = None):
+        obj = super().__new__(cls, verdict)
+        obj.score = score
+        return obj
+
+
+def content_words(text: str) -> List[str]:
+    """Lowercased words of text without stopwords."""
+    return [
+        word
+        for word in (match.lower() for match in _WORD.findall(text or ""))
+        if word not in _STOPWORDS
+    ]
+
+
+def hashing_vector(text: str, dims: int = HASH_DIMS) -> np.ndarray:
+    """
+    Hashed term-frequency vector of text's content words and word bigrams.
+    crc32 keeps the hashes stable across processes, unlike hash().
+    """
+    words = content_words(text)
+    terms = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    if not terms:
+        return np.zeros(dims)
+    indices = [zlib.crc32(term.encode()) % dims for term in terms]
+    counts = np.bincount(indices, minlength=dims).astype(float)
+    # Sublinear tf, so one repeated word cannot dominate the similarity.
+    return np.log1p(counts)
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> float:
+    norm = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / norm) if norm else 0.0
+
+
+def parse_context(context: Union[str, Dict[str, Any], None]) -> Dict[str, Any]:
+    """The ContextAgent JSON of a beat as a dict, whether stored as a dict or a string."""
+    if isinstance(context, dict):
+        return context
+    try:
+        parsed = json.loads(context or "")
+    except (TypeError, ValueError):
+        return {}
+    return parsed if isinstance(parsed, dict) else {}
+
+
+def beat_names(beat: str, context: Dict[str, Any]) -> Set[str]:
+    """
+    Character names beat mentions. Names come from the context's character list;
+    without one, capitalized words that do not start a sentence are taken instead.
+    """
+    known = {
+        str(character.get("name", "")).strip()
+        for character in context.get("characters") or []
+        if isinstance(character, dict)
+    }
+    mentioned = {name for name in known if name and name.lower() in beat.lower()}
+    if known:
+        return mentioned
+    names = set()
+    for sentence in re.split(r"[.!?:]\s+", beat):
+        for word in _WORD.findall(sentence)[1:]:
+            if word[0].isupper() and word.lower() not in _STOPWORDS:
+                names.add(word)
+    return names
+
+
+def score_passage(
+    passage: str,
+    beats: List[str],
+    context: Union[str, Dict[str, Any], None] = None,
+    dims: int = HASH_DIMS,
+) -> Dict[str, Any]:
+    """
+    Local consistency signals of a candidate passage for the beat pair [beat_a, beat_b].
+    Returns:
+    - similarity: Cosine of the passage's hashing vector with the beats', weighted
+      towards beat_b, which the passage has to lead into.
+    - names, named: Beat B's character names, and how many of them the passage mentions.
+    - location: Share of the context location's content words found in the passage,
+      or None if the context has no location.
+    """
+    context = parse_context(context)
+    beat_a, beat_b = beats[0], beats[-1]
+    text = passage.lower()
+    vector = hashing_vector(passage, dims)
+    similarity = 0.7 * cosine(vector, hashing_vector(beat_b, dims)) + 0.3 * cosine(
+        vector, hashing_vector(f"{beat_a} {beat_b}", dims)
+    )
+
+    names = beat_names(beat_b, context)
+    named = sum(1 for name in names if name.lower() in text)
+
+    setting = context.get("setting")
+    location_words = set(
+        content_words(str(setting.get("location", "")))
+        if isinstance(setting, dict)
+        else []
+    )
+    passage_words = set(content_words(passage))
+    location = (
+        len(location_words & passage_words) / len(location_words)
+        if location_words
+        else None
+    )
+
+    return {
+        "similarity": similarity,
+        "names": sorted(names),
+        "named": named,
+        "location": location,
+    }
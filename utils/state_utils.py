@@ -0,0 +1,225 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+
+def prefix_hashes(beats: List[str], signature: Dict[str, Any]) -> List[str]:
+    """
+    Chained hashes of the beat list: entry i covers the signature and beats[0..i].
+    Two beat lists share entry i exactly when they agree on every beat up to i,
+    so the first differing hash marks the first beat whose output must be redone.
+    """
+    digest = hashlib.sha256(
+        json.dumps(signature, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    hashes = []
+    for beat in beats:
+        digest = hashlib.sha256(f"{digest}\n{beat}".encode("utf-8")).hexdigest()
+        hashes.append(digest)
+    return hashes
+
+
+class RunStateStore:
+    """
+    SQLite-backed record of finished story work, keyed by beat prefix hash.
+    The row for prefix i holds the context of beat i and the accepted passage that
+    bridges beat i-1 into beat i; both depend only on the beats up to i, so a
+    resubmitted story with an edited beat reuses every row before the edit.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS run_state (
+                prefix TEXT PRIMARY KEY,
+                context TEXT,
+                passage TEXT,
+                passage_metadata TEXT,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._conn.commit()
+
+    def load(self, prefixes: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """Return the stored row for each prefix, None where nothing is stored."""
+        placeholders = ", ".join("?" for _ in prefixes)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT prefix, context, passage, passage_metadata FROM run_state WHERE prefix IN ({placeholders})",
+                prefixes,
+            ).fetchall()
+        found = {}
+        for prefix, context, passage, passage_metadata in rows:
+            found[prefix] = {
+                "context": json.loads(context) if context is not None else None,
+                "passage": passage,
+                "passage_metadata": (
+                    json.loads(passage_metadata) if passage_metadata else {}
+                ),
+            }
+        return [found.get(prefix) for prefix in prefixes]
+
+    def save_context(self, prefix: str, context: Any) -> None:
+        self._save(prefix, context=json.dumps(context))
+
+    def save_passage(
+        self, prefix: str, passage: str, metadata: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self._save(prefix, passage=passage, passage_metadata=json.dumps(metadata or {}))
+
+    def _save(self, prefix: str, **fields) -> None:
+        fields["updated_at"] = time.time()
+        columns = ", ".join(fields)
+        placeholders = ", ".join("?" for _ in fields)
+        updates = ", ".join(f"{key} = excluded.{key}" for key in fields)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO run_state (prefix, {columns}) VALUES (?, {placeholders}) "
+                f"ON CONFLICT(prefix) DO UPDATE SET {updates}",
+                (prefix, *fields.values()),
+            )
+            self._conn.commit()
+
+    def purge(self, max_age_seconds: float) -> int:
+        """Delete rows last written more than max_age_seconds ago."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM run_state WHERE updated_at < ?",
+                (time.time() - max_age_seconds,),
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+
+class IdempotencyConflictError(Exception):
+    """An idempotency key was reused for a request with a different payload."""
+
+
+class CheckpointStore:
+    """
+    SQLite-backed checkpoints of runs, keyed by the client's idempotency key.
+    A run records each finished stage ("context", "story", "done") with the state
+    needed to skip it, and each finished beat passage as it is produced, so a
+    retry with the same key resumes where the previous attempt stopped.
+    The fingerprint of the request is stored with the key; reusing the key for
+    a different request raises IdempotencyConflictError.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS checkpoints (
+                idempotency_key TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                state TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS checkpoint_passages (
+                idempotency_key TEXT NOT NULL,
+                beat INTEGER NOT NULL,
+                passage TEXT NOT NULL,
+                passage_metadata TEXT,
+                PRIMARY KEY (idempotency_key, beat)
+            )"""
+        )
+        self._conn.commit()
+
+    def load(self, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        Return {"stage", "state", "passages": {beat: (passage, metadata)}} stored
+        for key, or None if nothing is.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT fingerprint, stage, state FROM checkpoints WHERE idempotency_key = ?",
+                (key,),
+            ).fetchone()
+            if row is None:
+                return None
+            passages = self._conn.execute(
+                "SELECT beat, passage, passage_metadata FROM checkpoint_passages "
+                "WHERE idempotency_key = ?",
+                (key,),
+            ).fetchall()
+        if row[0] != fingerprint:
+            raise IdempotencyConflictError(
+                f"Idempotency key {key!r} was already used for a different request."
+            )
+        return {
+            "stage": row[1],
+            "state": json.loads(row[2]),
+            "passages": {
+                beat: (passage, json.loads(metadata) if metadata else {})
+                for beat, passage, metadata in passages
+            },
+        }
+
+    def save_stage(
+        self, key: str, fingerprint: str, stage: str, state: Dict[str, Any]
+    ) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO checkpoints (idempotency_key, fingerprint, stage, state, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(idempotency_key) DO UPDATE SET "
+                "stage = excluded.stage, state = excluded.state, updated_at = excluded.updated_at",
+                (key, fingerprint, stage, json.dumps(state), now, now),
+            )
+            self._conn.commit()
+
+    def save_passage(
+        self,
+        key: str,
+        beat: int,
+        passage: str,
+        metadata: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Record beat's passage; the key's stage checkpoint must already exist."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoint_passages VALUES (?, ?, ?, ?)",
+                (key, beat, passage, json.dumps(metadata or {})),
+            )
+            self._conn.execute(
+                "UPDATE checkpoints SET updated_at = ? WHERE idempotency_key = ?",
+                (time.time(), key),
+            )
+            self._conn.commit()
+
+    def purge(
+        self,
+        abandoned_after_seconds: float,
+        completed_after_seconds: Optional[float] = None,
+    ) -> int:
+        """
+        Delete checkpoints of runs that stopped before "done" and were not touched
+        for abandoned_after_seconds, and of finished runs older than
+        completed_after_seconds (defaults to abandoned_after_seconds).
+        Returns how many runs were deleted.
+        """
+        if completed_after_seconds is None:
+            completed_after_seconds = abandoned_after_seconds
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM checkpoints WHERE "
+                "(stage != 'done' AND updated_at < ?) OR (stage = 'done' AND updated_at < ?)",
+                (now - abandoned_after_seconds, now - completed_after_seconds),
+            )
+            self._conn.execute(
+                "DELETE FROM checkpoint_passages WHERE idempotency_key NOT IN "
+                "(SELECT idempotency_key FROM checkpoints)"
+            )
+            self._conn.commit()
+        return cursor.rowcount
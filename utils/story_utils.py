@@ -1,16 +1,59 @@
-from typing import Any, Dict, List, Optional
+import asyncio
+import re
+import time
+from contextlib import aclosing
+from typing import Any, Callable, Dict, List, Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr
 
 from utils.agents import (
     Agent,
     ContextAgent,
+    ContextDiffAgent,
     FlowAgent,
     LengthAgent,
     MetadataAgent,
+    PrefilterAgent,
     ProseAgent,
     StoryAgent,
+    StyleGenreRegistry,
 )
+from utils.budget_utils import Budget, BudgetExceededError
+from utils.cache_utils import ResponseCache
+from utils.context_utils import compact_json, encode_context
+from utils.llm_utils import count_tokens, fits_context_window, track_usage, use_budget
+from utils.model_utils import resolve_model
+from utils.prefilter_utils import score_passage
+from utils.state_utils import CheckpointStore, RunStateStore, prefix_hashes
+from utils.trace_utils import Trace
+from utils.validation_utils import ValidationChain, default_validators
+
+# What agenerate_story() puts after each passage of the story.
+PASSAGE_SEPARATOR = "\n"
+
+
+def _run_sync(coro):
+    """Run a pipeline coroutine to completion from synchronous code."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    coro.close()
+    raise RuntimeError(
+        "BeatToStory sync methods cannot run inside an event loop; await the a* methods instead."
+    )
+
+
+def _trim_to_sentence(text: str, max_words: int) -> Optional[str]:
+    """text cut back to the last sentence end within its first max_words words, if any."""
+    head = " ".join(text.split()[:max_words])
+    ends = list(re.finditer(r"[.!?][\"')\]]*(?=\s|$)", head))
+    return head[: ends[-1].end()] if ends else None
+
+
+def _tightest(*limits: Optional[float]) -> Optional[float]:
+    limits = [limit for limit in limits if limit is not None]
+    return min(limits) if limits else None
 
 
 class BeatToStory(BaseModel):
@@ -20,7 +63,61 @@ class BeatToStory(BaseModel):
     min_words_per_beat: int = 100
     max_words_per_beat: int = 150
     max_attempts_per_beat: int = 10
+    # Stream ProseAgent passages and stop a passage once it runs prose_overrun_words past
+    # max_words_per_beat; "trim" cuts it back to the last sentence end within the limit,
+    # "retry" leaves it over length for LengthAgent to reject.
+    stream_prose: bool = True
+    prose_overrun_words: int = 20
+    prose_overrun_action: Literal["trim", "retry"] = "trim"
+    # "feedback" tells each retry why the previous candidate was rejected (its word count
+    # against the bounds, or the check it failed); "resample" repeats the same prompt.
+    retry_mode: Literal["feedback", "resample"] = "feedback"
+    # Candidates generated concurrently per beat pair; 1 keeps the sequential retry loop.
+    speculative_candidates: int = 1
+    # Total candidates allowed per beat pair, defaults to max_attempts_per_beat.
+    max_candidates_per_beat: Optional[int] = None
+    # "serial" chains each ContextAgent call on the previous context, "parallel" extracts
+    # every beat concurrently and derives the change flags locally with ContextDiffAgent.
+    context_mode: Literal["serial", "parallel"] = "serial"
+    # How contexts are written into prompts: "raw" is the dict's repr, "compact" drops
+    # empty values and false flags, "delta" also leaves out what is unchanged since the
+    # previous beat (see encode_context).
+    context_encoding: Literal["raw", "compact", "delta"] = "compact"
+    # "full" edits the whole story in one FlowAgent call, "windowed" edits windows of
+    # edit_window_passages passages concurrently, each shown edit_window_overlap
+    # neighbouring passages on either side as read-only context.
+    edit_mode: Literal["full", "windowed"] = "full"
+    edit_window_passages: int = 3
+    edit_window_overlap: int = 1
+    # With a state_store and a cached FlowAgent, edit in windows even in "full" mode:
+    # windows whose text did not change are answered from the response cache, so a
+    # resubmitted story only pays to edit around the beats that changed.
+    incremental_edit: bool = True
+    # Thresholds of the local PrefilterAgent check in front of StoryAgent: similarity below
+    # prefilter_reject_below is rejected outright, at or above prefilter_accept_above (if
+    # set) accepted without StoryAgent. prefilter_shadow_rate of those clear verdicts
+    # still go to StoryAgent, to measure agreement.
+    prefilter_reject_below: float = 0.02
+    prefilter_accept_above: Optional[float] = None
+    prefilter_shadow_rate: float = 0.0
+    # Model per agent key, e.g. {"story": "fast", "context": "fast", "prose": "gpt-4o"};
+    # values are model names or latency classes (see resolve_model). "genre" and "style"
+    # route every genre/style rewrite agent. Unlisted agents keep their own llm.
+    agent_models: Dict[str, str] = {}
+    # With both a genre and a style, rewrite passages in one call that applies both
+    # instead of a genre rewrite followed by a style rewrite.
+    fused_rewrite: bool = True
+    # Genre/style rewrite agents shared by every run, keyed by guide; the least recently
+    # used is dropped past max_style_agents (see StyleGenreRegistry).
+    max_style_agents: int = 32
+    style_agents: Optional[StyleGenreRegistry] = None
+    # Ceilings new_run() puts on every run's Budget; a request may only tighten them.
+    max_cost_per_run: Optional[float] = None
+    max_seconds_per_run: Optional[float] = None
+    budget: Optional[Budget] = None
     story: Optional[str] = ""
+    # The passages story is made of, in beat order; story joins them with PASSAGE_SEPARATOR.
+    passages: List[str] = []
     edited_story: Optional[str] = ""
     beats: List[str] = []
     context: Dict[int, str] = {}
@@ -29,6 +126,28 @@ class BeatToStory(BaseModel):
     style: Optional[str] = None
     genre: Optional[str] = None
     agents: Optional[Dict[str, Agent]] = None
+    validation_chain: Optional[ValidationChain] = None
+    # Called as event_handler(event, data) when a stage produces output; when set,
+    # the FlowAgent edit is streamed token by token as "flow_token" events.
+    event_handler: Optional[Callable[[str, Dict[str, Any]], Any]] = None
+    token_cost: Dict[str, float] = {}
+    cache_hits: Dict[str, int] = {}
+    # Prompt tokens sent per agent, and how many of them the provider served from its prompt cache.
+    prompt_tokens: Dict[str, int] = {}
+    cached_tokens: Dict[str, int] = {}
+    # Prompt tokens per agent that context_encoding saved against the raw repr.
+    context_tokens_saved: Dict[str, int] = {}
+    response_cache: Optional[ResponseCache] = None
+    # Contexts and passages of earlier runs, reused when the same beat prefix comes back.
+    state_store: Optional[RunStateStore] = None
+    # With both set, every finished stage and beat passage is checkpointed under the
+    # key, and a run with a key that was checkpointed before resumes from there.
+    checkpoint_store: Optional[CheckpointStore] = None
+    idempotency_key: Optional[str] = None
+    # Spans of every agent call and stage of this run; they also feed the /metrics registry.
+    trace: Trace = Field(default_factory=Trace)
+    # Passages (and their metadata) by beat, restored from a checkpoint.
+    _resumed_passages: Dict[int, Any] = PrivateAttr(default_factory=dict)
 
     def update_metadata(self, metadata: Dict[str, Any]):
         """
@@ -45,31 +164,312 @@ class BeatToStory(BaseModel):
         """
         Initialize agents for the story pipeline.
         Can either use default agents or accept custom agents.
+        The validation chain defaults to the LengthAgent and StoryAgent checks.
         """
+        if self.validation_chain is None:
+            self.validation_chain = ValidationChain(
+                validators=default_validators(self.prefilter_shadow_rate)
+            )
+        if self.style_agents is None:
+            self.style_agents = StyleGenreRegistry(
+                max_agents=self.max_style_agents, prepare=self._opt_in_cache
+            )
         if not self.agents:
             self.agents = {
                 "context": ContextAgent(),
                 "prose": ProseAgent(
                     min_words=self.min_words_per_beat, max_words=self.max_words_per_beat
                 ),
+                "prefilter": PrefilterAgent(
+                    reject_below=self.prefilter_reject_below,
+                    accept_above=self.prefilter_accept_above,
+                ),
                 "story": StoryAgent(),
                 "length": LengthAgent(
                     min_words=self.min_words_per_beat, max_words=self.max_words_per_beat
                 ),
                 "flow": FlowAgent(),
             }
+            if self.context_mode == "parallel":
+                self.agents["context_diff"] = ContextDiffAgent()
+            for agent in self.agents.values():
+                self._opt_in_cache(agent)
+            self._route_agents()
+
+    def _route_agents(self):
+        """Swap in copies of the agents agent_models sends to another model."""
+        for name, agent in self.agents.items():
+            kind = (
+                name.rsplit("_", 1)[-1] if name.endswith(("_genre", "_style")) else None
+            )
+            route = self.agent_models.get(name) or self.agent_models.get(kind)
+            if route:
+                self.agents[name] = agent.with_model(resolve_model(route))
+
+    def _opt_in_cache(self, agent: Agent) -> Agent:
+        """Share the response cache with deterministic (temperature 0) LLM agents."""
+        if self.response_cache is not None and agent.llm and agent.temperature == 0.0:
+            agent.cache = self.response_cache
+        return agent
+
+    def new_run(
+        self,
+        beats: List[str],
+        user_metadata: Optional[Dict[str, Any]] = None,
+        max_cost: Optional[float] = None,
+        max_seconds: Optional[float] = None,
+        agent_models: Optional[Dict[str, str]] = None,
+        idempotency_key: Optional[str] = None,
+    ) -> "BeatToStory":
+        """
+        Create an isolated run that shares this pipeline's agents.
+        Only the agent dict is copied; beats, context, story, metadata and cost
+        all live on the returned run, so concurrent runs never see each other's state.
+        Arguments:
+        - beats: A list of story beat strings.
+        - user_metadata: Optional user metadata (setting, characters, genre, style).
+        - max_cost, max_seconds: Optional per-request budget, capped by this pipeline's
+          max_cost_per_run / max_seconds_per_run.
+        - agent_models: Optional per-request routes, merged over this pipeline's agent_models.
+        - idempotency_key: Optional client key to checkpoint the run under (and resume
+          it from), if this pipeline has a checkpoint_store.
+
+        Returns:
+        - A fresh BeatToStory ready for pipe().
+        """
+        self.setup_pipeline()
+        run = self.__class__(
+            min_words_per_beat=self.min_words_per_beat,
+            max_words_per_beat=self.max_words_per_beat,
+            max_attempts_per_beat=self.max_attempts_per_beat,
+            retry_mode=self.retry_mode,
+            stream_prose=self.stream_prose,
+            prose_overrun_words=self.prose_overrun_words,
+            prose_overrun_action=self.prose_overrun_action,
+            speculative_candidates=self.speculative_candidates,
+            max_candidates_per_beat=self.max_candidates_per_beat,
+            context_mode=self.context_mode,
+            context_encoding=self.context_encoding,
+            edit_mode=self.edit_mode,
+            edit_window_passages=self.edit_window_passages,
+            edit_window_overlap=self.edit_window_overlap,
+            incremental_edit=self.incremental_edit,
+            prefilter_reject_below=self.prefilter_reject_below,
+            prefilter_accept_above=self.prefilter_accept_above,
+            prefilter_shadow_rate=self.prefilter_shadow_rate,
+            agent_models={**self.agent_models, **(agent_models or {})},
+            fused_rewrite=self.fused_rewrite,
+            max_style_agents=self.max_style_agents,
+            style_agents=self.style_agents,
+            max_cost_per_run=self.max_cost_per_run,
+            max_seconds_per_run=self.max_seconds_per_run,
+            response_cache=self.response_cache,
+            state_store=self.state_store,
+            checkpoint_store=self.checkpoint_store,
+            idempotency_key=idempotency_key,
+            beats=beats,
+            agents=dict(self.agents),
+            validation_chain=self.validation_chain.model_copy(update={"stats": {}}),
+        )
+
+        if user_metadata:
+            run.update_metadata(user_metadata)
+            if run.genre and run.style and run.fused_rewrite:
+                run.agents[f"{run.genre}+{run.style}_style"] = run.style_agents.get(
+                    run.style, genre=run.genre
+                )
+            else:
+                if run.genre:
+                    run.agents[f"{run.genre}_genre"] = run.style_agents.get(run.genre)
+                if run.style:
+                    run.agents[f"{run.style}_style"] = run.style_agents.get(run.style)
+            run.agents["meta"] = MetadataAgent()
+        run._route_agents()
+
+        max_cost = _tightest(max_cost, self.max_cost_per_run)
+        max_seconds = _tightest(max_seconds, self.max_seconds_per_run)
+        if max_cost is not None or max_seconds is not None:
+            run.budget = Budget(max_cost=max_cost, max_seconds=max_seconds)
+
+        return run
+
+    def _rewrite_agents(self) -> List[str]:
+        """Keys of the genre/style rewrite agents of this run, in the order they apply."""
+        names = [
+            f"{self.genre}+{self.style}_style",
+            f"{self.genre}_genre",
+            f"{self.style}_style",
+        ]
+        return [name for name in names if name in self.agents]
+
+    def _call_agent(self, name: str, *args, **kwargs):
+        """Call an agent by name, charge the cost of the call to this run and trace it."""
+        with self.trace.span(name, kind="agent") as span:
+            with track_usage() as usage:
+                result = self.agents[name](*args, **kwargs)
+            self._charge(name, usage, span, result)
+        return result
+
+    async def _acall_agent(self, name: str, *args, **kwargs):
+        """Async version of _call_agent."""
+        with self.trace.span(name, kind="agent") as span:
+            with track_usage() as usage:
+                result = await self.agents[name].acall(*args, **kwargs)
+            self._charge(name, usage, span, result)
+        return result
+
+    async def _acall_optional(self, name: str, fallback, *args, **kwargs):
+        """Call an optional stage; if the budget refuses it, skip it and return fallback."""
+        try:
+            return await self._acall_agent(name, *args, **kwargs)
+        except BudgetExceededError:
+            self.budget.skip(name)
+            return fallback
+
+    def _charge(self, name: str, usage: Dict[str, Any], span=None, result=None):
+        if span is not None:
+            span.record_usage(usage)
+            if self.validation_chain is not None and any(
+                v.agent == name for v in self.validation_chain.validators
+            ):
+                span.outcome = {"True": "accepted", "Unsure": "deferred"}.get(
+                    str(result).strip(), "rejected"
+                )
+        self.token_cost[name] = self.token_cost.get(name, 0.0) + usage["cost"]
+        if usage["cache_hits"]:
+            self.cache_hits[name] = self.cache_hits.get(name, 0) + usage["cache_hits"]
+        if usage["prompt_tokens"]:
+            self.prompt_tokens[name] = (
+                self.prompt_tokens.get(name, 0) + usage["prompt_tokens"]
+            )
+            self.cached_tokens[name] = (
+                self.cached_tokens.get(name, 0) + usage["cached_tokens"]
+            )
+
+    def _encode_context(self, name: str, context, previous=None):
+        """
+        Write context into agent name's prompt per context_encoding, counting the
+        tokens saved against the raw repr. ContextAgent, which has to echo every
+        field back, gets compact JSON rather than the delta form. Missing contexts
+        and "raw" encoding pass the context through unchanged.
+        """
+        if self.context_encoding == "raw" or not context:
+            return context
+        raw = str(context)
+        if name == "context":
+            encoded = compact_json(context)
+        else:
+            encoded = encode_context(context, previous, mode=self.context_encoding)
+        saved = count_tokens(raw) - count_tokens(encoded)
+        self.context_tokens_saved[name] = self.context_tokens_saved.get(name, 0) + saved
+        return encoded
+
+    def _load_state(self):
+        """
+        Prefix hashes of this run's beats and the state_store row stored for each.
+        The hashes cover everything a context or passage depends on besides the
+        beats: word limits, context mode and encoding, user metadata and the agents' models.
+        """
+        if self.state_store is None or not self.beats:
+            return [], []
+        prefixes = prefix_hashes(self.beats, self._signature())
+        return prefixes, self.state_store.load(prefixes)
+
+    def _signature(self) -> Dict[str, Any]:
+        return {
+            "min_words_per_beat": self.min_words_per_beat,
+            "max_words_per_beat": self.max_words_per_beat,
+            "context_mode": self.context_mode,
+            "context_encoding": self.context_encoding,
+            "user_metadata": self.user_metadata or {},
+            "models": {name: agent.llm for name, agent in self.agents.items()},
+        }
+
+    def _checkpointing(self) -> bool:
+        return (
+            self.checkpoint_store is not None
+            and bool(self.idempotency_key)
+            and bool(self.beats)
+        )
+
+    def _fingerprint(self) -> str:
+        """Hash of the request behind this run: its beats and everything in _signature()."""
+        return prefix_hashes(self.beats, self._signature())[-1]
+
+    def _checkpoint(self, stage: str):
+        """Record that stage finished, with the state a resumed run needs to skip it."""
+        if not self._checkpointing():
+            return
+        self.checkpoint_store.save_stage(
+            self.idempotency_key,
+            self._fingerprint(),
+            stage,
+            {
+                "context": self.context,
+                "story": self.story,
+                "passages": self.passages,
+                "edited_story": self.edited_story,
+                "generation_metadata": self.generation_metadata,
+            },
+        )
+
+    def _resume(self) -> Optional[str]:
+        """
+        Restore the state of the last checkpoint stored under idempotency_key.
+        Returns the stage it was taken after, or None if there is none. Costs are
+        not restored: pipeline_cost() only covers what this run spends.
+        Raises IdempotencyConflictError if the key belongs to a different request.
+        """
+        if not self._checkpointing():
+            return None
+        checkpoint = self.checkpoint_store.load(
+            self.idempotency_key, self._fingerprint()
+        )
+        if checkpoint is None:
+            return None
+        state = checkpoint["state"]
+        # JSON turned the beat indices into strings.
+        self.context = {int(i): context for i, context in state["context"].items()}
+        self.story = state["story"]
+        self.passages = state.get("passages", [])
+        self.edited_story = state["edited_story"]
+        self.generation_metadata = state["generation_metadata"]
+        self._resumed_passages = checkpoint["passages"]
+        self.generation_metadata["resumed"] = {
+            "stage": checkpoint["stage"],
+            "passages": len(self._resumed_passages),
+        }
+        return checkpoint["stage"]
+
+    def _emit(self, event: str, data: Dict[str, Any]):
+        if self.event_handler is not None:
+            self.event_handler(event, data)
 
     def describe_pipeline(self):
         """Return description of all agents in pipeline order"""
         return "\n\n".join(self.agents[name].describe() for name in self.agents.keys())
 
     def pipeline_cost(self):
-        """Return cost of all agents in pipeline order"""
-        cost_dict = {name: self.agents[name].token_cost for name in self.agents.keys()}
+        """
+        Return cost of all agents in pipeline order, for this run only.
+        "prompt_tokens" and "cached_tokens" hold the per-agent prompt token counts and
+        how many of those the provider's prompt cache served; "models" the model each
+        LLM agent was routed to; "context_tokens_saved" the prompt tokens per agent
+        that context_encoding saved.
+        """
+        cost_dict = {
+            name: self.token_cost.get(name, 0.0) for name in self.agents.keys()
+        }
         cost_dict["total"] = sum(cost_dict.values())
+        cost_dict["prompt_tokens"] = dict(self.prompt_tokens)
+        cost_dict["cached_tokens"] = dict(self.cached_tokens)
+        cost_dict["context_tokens_saved"] = dict(self.context_tokens_saved)
+        cost_dict["models"] = {
+            name: agent.llm for name, agent in self.agents.items() if agent.llm
+        }
         return cost_dict
 
-    def get_context(self, verbose=False):
+    async def aget_context(self, verbose=False):
         """
         Generates a context for each beat in the story. This context is used by the prose_agent to generate a connecting passage.
         This operates as story metadata that is created by the beats and is meant to help outline the scene and story logic.
@@ -87,15 +487,61 @@ class BeatToStory(BaseModel):
                 "No beats provided. Please add beats before generating story."
             )
 
-        previous_context = None
         if verbose:
             print("Generating context from beats...")
-        for i in range(len(self.beats) - 1):
+
+        # Contexts of an unchanged beat prefix are reused from an earlier run.
+        prefixes, rows = self._load_state()
+        start = 0
+        while start < len(rows) - 1 and rows[start] and rows[start]["context"]:
+            self.context[start] = rows[start]["context"]
+            start += 1
+        if prefixes:
+            self.generation_metadata["reused_contexts"] = start
             if verbose:
-                print(f"    crafting context on beat {i}")
-            context = self.agents["context"](self.beats[i], previous_context)
-            self.context[i] = context
-            previous_context = context
+                print(f"    reusing {start} stored contexts")
+
+        if self.context_mode == "parallel":
+            await self._aget_context_parallel(start=start, verbose=verbose)
+        else:
+            previous_context = self.context.get(start - 1)
+            for i in range(start, len(self.beats) - 1):
+                if verbose:
+                    print(f"    crafting context on beat {i}")
+                context = await self._acall_agent(
+                    "context",
+                    self.beats[i],
+                    self._encode_context("context", previous_context),
+                )
+                self.context[i] = context
+                previous_context = context
+
+        for i in range(start, len(prefixes) - 1):
+            self.state_store.save_context(prefixes[i], self.context[i])
+
+        return self.context
+
+    async def _aget_context_parallel(self, start=0, verbose=False):
+        """
+        Extracts every beat's context from start on concurrently, without a previous
+        context, then lets ContextDiffAgent set location_change/status_change in beat order.
+        """
+        if "context_diff" not in self.agents:
+            raise ValueError(
+                "ContextDiffAgent not found in agents. Please add a ContextDiffAgent to the pipeline."
+            )
+        if verbose:
+            print(
+                f"    crafting context on {len(self.beats) - 1 - start} beats concurrently"
+            )
+        contexts = await asyncio.gather(
+            *(
+                self._acall_agent("context", self.beats[i])
+                for i in range(start, len(self.beats) - 1)
+            )
+        )
+        contexts = {**self.context, **dict(enumerate(contexts, start))}
+        self.context = self._call_agent("context_diff", contexts)
 
     def update_context_with_meta(self, verbose=False):
         if not self.context:
@@ -107,88 +553,379 @@ class BeatToStory(BaseModel):
             )
         if verbose:
             print("Updating context with metadata...")
-        self.context = self.agents["meta"](self.context, self.user_metadata)
+        self.context = self._call_agent("meta", self.context, self.user_metadata)
 
-    def generate_story(self, verbose=False):
+    async def agenerate_story(self, verbose=False):
         """
         Generates a complete story from a list of story beats.
         For each pair of beats:
         1. Use ProseAgent to generate a connecting passage
-        2. If present, use GenreAgent and StyleAgent to modify the passage
-        3. Use StoryAgent to verify consistency; if not, retry
-        4. Use LengthAgent to check length requirements; if not, retry
+        2. Run the "pre" validators (local checks such as LengthAgent); if one fails, retry
+        3. If present, use GenreAgent and StyleAgent (or one fused agent) to modify the passage
+        4. Run the "post" validators cheapest first (LengthAgent, then StoryAgent); if one fails, retry
+        With speculative_candidates > 1, that many candidates run concurrently per
+        beat pair; the first one to pass is accepted and the rest are cancelled.
+        With retry_mode="feedback", candidates launched after a rejection are told why
+        it happened. Candidates per beat are counted in generation_metadata
+        ("attempts_per_beat", "mean_attempts_per_beat"). Each accepted passage records
+        its latency and the part spent on rewrites ("passage_seconds",
+        "rewrite_seconds"), summarized per run under "rewrite".
+        With a state_store, passages up to the first edited beat are reused from an
+        earlier run of the same beats instead of being generated again.
         """
         self._check_state()
+        if self.validation_chain is None:
+            self.validation_chain = ValidationChain(
+                validators=default_validators(self.prefilter_shadow_rate)
+            )
         current_passage = None
+        prefixes, rows = self._load_state()
+        reused = resumed = 0
 
         # For each pair of beats, generate and validate a connecting passage
         if verbose:
             print("Generating story from beats...")
         for i in range(len(self.beats) - 1):
-            beat_a = self.beats[i]
-            beat_b = self.beats[i + 1]
+            # The passage into beat i+1 is stored under prefix i+1; reuse stops at the
+            # first miss, since every later passage continues from a new one.
+            row = rows[i + 1] if reused + resumed == i and rows else None
+            checkpointed = reused + resumed == i and i in self._resumed_passages
+            if checkpointed:
+                # Passages a checkpointed run of this request already produced.
+                generated_passage, passage_metadata = self._resumed_passages[i]
+                if passage_metadata:
+                    self.generation_metadata[f"beat_{i}"] = passage_metadata
+                resumed += 1
+            elif row and row["passage"] is not None:
+                generated_passage = row["passage"]
+                self.generation_metadata[f"beat_{i}"] = {
+                    **row["passage_metadata"],
+                    "reused": True,
+                }
+                reused += 1
+            else:
+                try:
+                    generated_passage, _, verified = await self._generate_beat_passage(
+                        i, current_passage, verbose=verbose
+                    )
+                except BudgetExceededError as e:
+                    if verbose:
+                        print(
+                            f"Budget exhausted at beat {i}, stopping the story here: {e}"
+                        )
+                    self.budget.skip(f"beat_{i}")
+                    break
+                # Only passages that passed every check and rewrite are offered to
+                # later runs; budget-skipped ones are not.
+                if prefixes and verified:
+                    self.state_store.save_passage(
+                        prefixes[i + 1],
+                        generated_passage,
+                        self.generation_metadata.get(f"beat_{i}"),
+                    )
 
-            for idx, _ in enumerate(range(self.max_attempts_per_beat)):
-                generated_passage = self.agents["prose"](
-                    current_passage, beat_a, beat_b, context_summary=self.context[i]
+            # Every passage of the story is checkpointed, reused ones included, so a
+            # resumed run finds the whole prefix it already has.
+            if self._checkpointing() and not checkpointed:
+                self.checkpoint_store.save_passage(
+                    self.idempotency_key,
+                    i,
+                    generated_passage,
+                    self.generation_metadata.get(f"beat_{i}"),
                 )
+            self.story += f"{generated_passage}{PASSAGE_SEPARATOR}"
+            self.passages.append(generated_passage)
+            current_passage = generated_passage
+            self._emit("passage", {"beat": i, "passage": generated_passage})
 
-                if verbose:
-                    print(f"    ProseAgent output (iteration {i+1}, attempt {idx+1})")
-
-                # Apply style/genre transformations
-                if f"{self.genre}_genre" in self.agents.keys():
-                    if verbose:
-                        print(f"Applying {self.genre} genre transformation...")
-                    generated_passage = self.agents[f"{self.genre}_genre"](
-                        generated_passage
-                    )
+        self.generation_metadata["validation"] = self.validation_chain.stats
+        attempts = self.generation_metadata.get("attempts_per_beat")
+        if attempts:
+            self.generation_metadata["mean_attempts_per_beat"] = sum(
+                attempts.values()
+            ) / len(attempts)
+        if prefixes:
+            self.generation_metadata["reused_passages"] = reused
+        self.generation_metadata["rewrite"] = self._rewrite_summary()
+        return self.story
 
-                if f"{self.style}_style" in self.agents.keys():
-                    if verbose:
-                        print(f"Applying {self.style} stylistic transformation...")
-                    generated_passage = self.agents[f"{self.style}_style"](
-                        generated_passage
-                    )
+    async def _generate_beat_passage(self, i, current_passage, verbose=False):
+        """
+        Runs candidates for beat pair i until one passes, keeping up to
+        speculative_candidates in flight and launching at most
+        max_candidates_per_beat (default: max_attempts_per_beat) in total.
+        Returns (passage, passed, verified): the accepted passage and True, or the
+        last finished one and False if none passed. verified is False when the
+        budget skipped a check or rewrite of the accepted passage.
+        """
+        with self.trace.span("beat", beat=i) as span:
+            passage, passed, verified = await self._run_beat_candidates(
+                i, current_passage, verbose
+            )
+            span.outcome = "accepted" if passed else "unverified"
+        return passage, passed, verified
 
-                consistency = self.agents["story"](generated_passage, [beat_a, beat_b])
-                if consistency != "True":
-                    if verbose:
-                        print(
-                            f"        beat {i} | attempt: {idx} | Inconsistency detected; regenerating passage..."
-                        )
-                    continue
+    async def _run_beat_candidates(self, i, current_passage, verbose=False):
+        max_candidates = self.max_candidates_per_beat or self.max_attempts_per_beat
+        width = max(1, self.speculative_candidates)
+        pending = set()
+        attempt_of = {}
+        launched = finished = 0
+        accepted = accepted_attempt = last_passage = feedback = None
+        verified = False
 
-                length_ok = self.agents["length"](generated_passage)
-                if not length_ok:
-                    if verbose:
-                        print(
-                            f"        beat {i} | attempt: {idx} | Length requirement not met {len(generated_passage.split())}; regenerating passage..."
+        try:
+            while accepted is None and (pending or launched < max_candidates):
+                while launched < max_candidates and len(pending) < width:
+                    launched += 1
+                    task = asyncio.create_task(
+                        self._attempt_passage(
+                            i,
+                            current_passage,
+                            launched,
+                            feedback=feedback,
+                            verbose=verbose,
                         )
-                    continue  # Rerun prose_agent
-
-                # If both checks pass, store metadata and break
-                self.generation_metadata["beat_" + str(i)] = {
-                    "attempts": idx + 1,
-                    "passage": generated_passage,
-                    "passage_length": len(generated_passage.split()),
-                    "exceeded_max_attempts": idx + 1 == self.max_attempts_per_beat,
-                }
-                break
-            else:
-                if verbose:
-                    print(
-                        f"Max attempts reached for beats {i}. Accepting the last generated passage."
                     )
+                    attempt_of[task] = launched
+                    pending.add(task)
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    finished += 1
+                    try:
+                        last_passage, passed, checked, rejection = task.result()
+                    except BudgetExceededError:
+                        # The budget refused a candidate; let the ones in flight finish.
+                        max_candidates = launched
+                        continue
+                    if passed and accepted is None:
+                        accepted = last_passage
+                        accepted_attempt = attempt_of[task]
+                        verified = checked
+                    elif self.retry_mode == "feedback":
+                        # Candidates launched from here on are told what went wrong.
+                        feedback = rejection
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
 
-            self.story += f"{generated_passage}\n"
-            current_passage = generated_passage
+        self.generation_metadata.setdefault("attempts_per_beat", {})[
+            f"beat_{i}"
+        ] = finished
+        candidates = {
+            "candidates_launched": launched,
+            "candidates_cancelled": len(pending),
+            "candidates_wasted": launched - (accepted is not None),
+        }
+        if accepted is None:
+            if last_passage is None:
+                raise BudgetExceededError(f"No passage could be afforded for beat {i}.")
+            if verbose:
+                print(
+                    f"Max attempts reached for beats {i}. Accepting the last generated passage."
+                )
+            return last_passage, False, False
 
-        return self.story
+        # If both checks pass, store metadata
+        self.generation_metadata["beat_" + str(i)] = {
+            "attempts": finished,
+            "passage": accepted,
+            "passage_length": len(accepted.split()),
+            "exceeded_max_attempts": finished == max_candidates,
+            "verified": verified,
+            **candidates,
+            **self._passage_timing(i, accepted_attempt),
+        }
+        return accepted, True, verified
 
-    def edit_story(self, verbose=False):
+    def _passage_timing(self, i: int, attempt: int) -> Dict[str, float]:
+        """
+        Seconds the accepted attempt of beat pair i took end to end, and how many of
+        them went to genre/style rewrites, read from its trace spans.
+        """
+        rewrites = set(self._rewrite_agents())
+        passage_seconds = rewrite_seconds = 0.0
+        for span in self.trace.spans:
+            if span.beat != i or span.attempt != attempt:
+                continue
+            if span.name == "attempt" and span.kind == "stage":
+                passage_seconds = span.duration
+            elif span.kind == "agent" and span.name in rewrites:
+                rewrite_seconds += span.duration
+        return {"passage_seconds": passage_seconds, "rewrite_seconds": rewrite_seconds}
+
+    def _rewrite_summary(self) -> Dict[str, Any]:
+        """Rewrite mode of this run and mean latency of its accepted, generated passages."""
+        rewrites = self._rewrite_agents()
+        timings = [
+            meta
+            for key, meta in self.generation_metadata.items()
+            if str(key).startswith("beat_")
+            and isinstance(meta, dict)
+            and "passage_seconds" in meta
+            and not meta.get("reused")
+        ]
+        summary = {
+            "mode": (
+                "fused"
+                if any("+" in name for name in rewrites)
+                else "sequential" if rewrites else "none"
+            ),
+            "agents": rewrites,
+            "passages": len(timings),
+        }
+        if timings:
+            passage = sum(meta["passage_seconds"] for meta in timings) / len(timings)
+            rewrite = sum(meta["rewrite_seconds"] for meta in timings) / len(timings)
+            summary["mean_passage_seconds"] = passage
+            summary["mean_rewrite_seconds"] = rewrite
+            summary["rewrite_share"] = rewrite / passage if passage else 0.0
+        return summary
+
+    async def _attempt_passage(
+        self, i, current_passage, idx, feedback=None, verbose=False
+    ):
+        """
+        Generate one candidate passage for beat pair i and run the checks on it.
+        Returns (passage, passed, verified, feedback on the rejection or None).
+        verified is False for a passage accepted without every check and rewrite
+        because the budget refused them.
+        """
+        with self.trace.span("attempt", beat=i, attempt=idx) as span:
+            passage, passed, verified, rejection = await self._run_attempt(
+                i, current_passage, idx, feedback=feedback, verbose=verbose
+            )
+            span.outcome = "accepted" if passed else "rejected"
+        return passage, passed, verified, rejection
+
+    def _rejection_feedback(self, rejected: str, passage: str, i: int) -> str:
+        """What to tell the next ProseAgent attempt about a check the passage failed."""
+        if rejected == "length":
+            return (
+                f"It was {len(passage.split())} words long, but it must be between "
+                f"{self.min_words_per_beat} and {self.max_words_per_beat} words."
+            )
+        if rejected == "prefilter":
+            signals = score_passage(
+                passage, [self.beats[i], self.beats[i + 1]], self.context[i]
+            )
+            if signals["names"] and not signals["named"]:
+                return (
+                    f"It never mentions {', '.join(signals['names'])}, who the next "
+                    "beat is about."
+                )
+            return "It strayed from the beats; keep to the events of the two beats."
+        if rejected == "story":
+            return (
+                "A consistency check found it does not fit the beats: it must not "
+                "contradict either beat, must move from the first beat toward the "
+                "second, and must not introduce major new elements."
+            )
+        return f"It failed the {rejected} check."
+
+    async def _run_attempt(self, i, current_passage, idx, feedback=None, verbose=False):
+        beat_a = self.beats[i]
+        beat_b = self.beats[i + 1]
+
+        prose_args = (current_passage, beat_a, beat_b)
+        prose_kwargs = {
+            "context_summary": self._encode_context(
+                "prose",
+                self.context[i],
+                previous=self.context.get(i - 1) if current_passage else None,
+            )
+        }
+        if feedback:
+            prose_kwargs["feedback"] = feedback
+        if self.stream_prose:
+            generated_passage = await self._astream_prose(
+                i, idx, *prose_args, **prose_kwargs
+            )
+        else:
+            generated_passage = await self._acall_agent(
+                "prose", *prose_args, **prose_kwargs
+            )
+
+        if verbose:
+            print(f"    ProseAgent output (iteration {i+1}, attempt {idx})")
+
+        # Free local checks run before paying for transforms and LLM checks
+        verdicts = {}
+        rejected = await self.validation_chain.run(
+            "pre",
+            generated_passage,
+            [beat_a, beat_b],
+            self._acall_agent,
+            self.agents,
+            context=self.context[i],
+            verdicts=verdicts,
+        )
+        if rejected:
+            if verbose:
+                print(
+                    f"        beat {i} | attempt: {idx} | {rejected} check failed before transforms; regenerating passage..."
+                )
+            return (
+                generated_passage,
+                False,
+                False,
+                self._rejection_feedback(rejected, generated_passage, i),
+            )
+
+        # Apply style/genre transformations; one the budget refuses is skipped, which
+        # leaves the passage unverified.
+        raw_passage = generated_passage
+        verified = True
+        for name in self._rewrite_agents():
+            if verbose:
+                print(f"Applying {name.rsplit('_', 1)[0]} transformation...")
+            try:
+                generated_passage = await self._acall_agent(name, generated_passage)
+            except BudgetExceededError:
+                self.budget.skip(name)
+                verified = False
+
+        try:
+            rejected = await self.validation_chain.run(
+                "post",
+                generated_passage,
+                [beat_a, beat_b],
+                self._acall_agent,
+                self.agents,
+                transformed=generated_passage != raw_passage,
+                context=self.context[i],
+                verdicts=verdicts,
+            )
+        except BudgetExceededError:
+            # Out of budget for the LLM checks: accept the passage unverified.
+            self.budget.skip("validation")
+            return generated_passage, True, False, None
+        if rejected:
+            if verbose:
+                print(
+                    f"        beat {i} | attempt: {idx} | {rejected} check failed ({len(generated_passage.split())} words); regenerating passage..."
+                )
+            return (
+                generated_passage,
+                False,
+                False,
+                self._rejection_feedback(rejected, generated_passage, i),
+            )
+
+        return generated_passage, True, verified, None
+
+    async def aedit_story(self, verbose=False):
         """
         Edits story by adding in the flow_agent
+        With edit_mode="windowed" the story is edited in concurrent windows instead,
+        so the edit takes about as long as one window whatever the story length.
+        A story too long for the flow model's context window is always edited in windows.
+        So is every story of a run with a state_store and a cached FlowAgent, unless
+        incremental_edit is off. A resubmission then pays only for the windows around
+        changed beats.
         arguments:
         - verbose: If True, prints out the steps of the story editing process
         """
@@ -199,38 +936,231 @@ class BeatToStory(BaseModel):
 
         if verbose:
             print("Editing story...")
-        self.edited_story = self.agents["flow"](
-            self.story, self.max_words_per_beat * len(self.beats)
+        max_words = self.max_words_per_beat * len(self.beats)
+        windowed = self.edit_mode == "windowed" or (
+            self.incremental_edit
+            and self.state_store is not None
+            and self.agents["flow"].cache is not None
         )
+        if not windowed:
+            request = self.agents["flow"].build_request(self.story, max_words)
+            windowed = not fits_context_window(
+                self.agents["flow"].llm,
+                request["messages"],
+                request.get("max_tokens", 400),
+            )
+        try:
+            if windowed:
+                self.edited_story = await self._aedit_windowed(verbose=verbose)
+            elif self.event_handler is None:
+                self.edited_story = await self._acall_agent(
+                    "flow", self.story, max_words
+                )
+            else:
+                self.edited_story = await self._astream_edit(max_words)
+        except BudgetExceededError as e:
+            # Editing is optional: return the unedited story rather than overspend.
+            if verbose:
+                print(f"Skipping edit: {e}")
+            self.budget.skip("flow")
+            self.edited_story = self.story.strip()
 
         return self.edited_story
 
-    def pipe(self, verbose=False):
+    def edit_windows(self) -> List[Dict[str, str]]:
+        """
+        Split the story at passage boundaries into edit windows.
+        Each window holds up to edit_window_passages passages to revise, plus the
+        edit_window_overlap passages before and after it as read-only context.
+        Windows do not overlap in what they revise, so joining the edited windows
+        in order gives the whole story back. A story set by hand rather than by
+        agenerate_story() has no passage list and is split at its lines.
+        """
+        passages = [p.strip() for p in self.passages] or [
+            p.strip() for p in self.story.split("\n") if p.strip()
+        ]
+        size = max(1, self.edit_window_passages)
+        overlap = max(0, self.edit_window_overlap)
+        windows = []
+        for start in range(0, len(passages), size):
+            end = min(start + size, len(passages))
+            windows.append(
+                {
+                    "text": PASSAGE_SEPARATOR.join(passages[start:end]),
+                    "preceding": PASSAGE_SEPARATOR.join(
+                        passages[max(0, start - overlap) : start]
+                    ),
+                    "following": PASSAGE_SEPARATOR.join(passages[end : end + overlap]),
+                    "passages": end - start,
+                }
+            )
+        return windows
+
+    async def _aedit_windowed(self, verbose=False):
+        """Edit every window concurrently and stitch the results back in story order."""
+        windows = self.edit_windows()
+        if verbose:
+            print(f"    Editing {len(windows)} windows concurrently...")
+
+        async def edit(i, window):
+            # A window the budget cannot afford is kept as written.
+            edited = await self._acall_optional(
+                "flow",
+                window["text"],
+                window["text"],
+                self.max_words_per_beat * window["passages"],
+                preceding=window["preceding"] or None,
+                following=window["following"] or None,
+            )
+            edited = str(edited).strip() or window["text"]
+            self._emit("flow_window", {"window": i, "text": edited})
+            return edited
+
+        edited = await asyncio.gather(
+            *(edit(i, window) for i, window in enumerate(windows))
+        )
+        self.generation_metadata["edit_windows"] = len(windows)
+        return PASSAGE_SEPARATOR.join(edited)
+
+    async def _astream_prose(self, i, idx, *args, **kwargs):
+        """
+        Stream a ProseAgent passage, counting words as they arrive. Past
+        max_words_per_beat + prose_overrun_words the stream is closed, which stops
+        generation, and the passage is trimmed or left for LengthAgent to reject
+        (prose_overrun_action). Aborted attempts are recorded under
+        generation_metadata["prose_aborts"][f"beat_{i}"] with the tokens and seconds
+        saved, estimated against the call running on to its max_tokens.
+        """
+        agent = self.agents["prose"]
+        limit = self.max_words_per_beat + self.prose_overrun_words
+        chunks, aborted, first_token = [], False, None
+        with self.trace.span("prose", kind="agent") as span:
+            with track_usage() as usage:
+                async with aclosing(agent.astream(*args, **kwargs)) as stream:
+                    async for delta, _ in stream:
+                        first_token = first_token or time.perf_counter()
+                        chunks.append(delta)
+                        if len("".join(chunks).split()) > limit:
+                            aborted = True
+                            break
+            self._charge("prose", usage, span)
+        passage = "".join(chunks).strip()
+        if not aborted:
+            return passage
+
+        # Seconds per token of this stream, after the first token arrived.
+        elapsed = time.perf_counter() - first_token
+        generated = max(1, usage["completion_tokens"])
+        max_tokens = agent.build_request(*args, **kwargs).get("max_tokens", 400)
+        saved = max(0, max_tokens - generated)
+        trimmed = (
+            _trim_to_sentence(passage, self.max_words_per_beat)
+            if self.prose_overrun_action == "trim"
+            else None
+        )
+        self.generation_metadata.setdefault("prose_aborts", {}).setdefault(
+            f"beat_{i}", []
+        ).append(
+            {
+                "attempt": idx,
+                "words": len(passage.split()),
+                "action": "trimmed" if trimmed else "retry",
+                "tokens_saved": saved,
+                "seconds_saved": round(elapsed / generated * saved, 3),
+            }
+        )
+        return trimmed or passage
+
+    async def _astream_edit(self, max_words):
+        """Run FlowAgent as a stream, emitting each token as a flow_token event."""
+        edited = []
+        with self.trace.span("flow", kind="agent") as span:
+            with track_usage() as usage:
+                async for delta, _ in self.agents["flow"].astream(
+                    self.story, max_words
+                ):
+                    if delta:
+                        edited.append(delta)
+                        self._emit("flow_token", {"text": delta})
+            self._charge("flow", usage, span)
+        return "".join(edited).strip()
+
+    async def apipe(self, verbose=False):
         """
         Generates a complete edited story using the agents we've designed above.
+        If the run has a Budget, every LLM call is checked against it first: optional
+        stages (genre/style rewrites, LLM checks, the final edit) are skipped and
+        retries stop once it runs out.
+        With a checkpoint_store and an idempotency_key, the context, each passage, the
+        story and the edit are checkpointed as they finish, and a run under a key
+        that was checkpointed before picks up after the last checkpoint.
         """
         state = self._check_state()
         if state != "OK":
             if verbose:
                 print(f"Note: {state}")
 
-        if self.context == {}:
-            self.get_context(verbose=verbose)
+        resumed = self._resume()
+        if resumed and verbose:
+            print(f"Resuming after the {resumed} checkpoint...")
 
-        if self.user_metadata and any(
-            isinstance(agent, MetadataAgent) for agent in self.agents.values()
-        ):
-            self.update_context_with_meta(verbose=verbose)
+        with use_budget(self.budget), self.trace.span("pipeline"):
+            if self.context == {}:
+                with self.trace.span("context"):
+                    await self.aget_context(verbose=verbose)
 
-        if self.story == "":
-            self.generate_story(verbose=verbose)
+            # A checkpointed context already went through MetadataAgent.
+            if (
+                resumed is None
+                and self.user_metadata
+                and any(
+                    isinstance(agent, MetadataAgent) for agent in self.agents.values()
+                )
+            ):
+                self.update_context_with_meta(verbose=verbose)
+            if resumed is None:
+                self._checkpoint("context")
+            self._emit("context", {"context": self.context})
 
-        if verbose:
-            print("Editing story...")
-        self.edit_story()
+            if self.story == "":
+                with self.trace.span("story"):
+                    await self.agenerate_story(verbose=verbose)
+                if not (self.budget and self.budget.exhausted):
+                    self._checkpoint("story")
+
+            if not self.edited_story and (
+                self.story or not (self.budget and self.budget.exhausted)
+            ):
+                if verbose:
+                    print("Editing story...")
+                with self.trace.span("edit"):
+                    await self.aedit_story()
+                if not (self.budget and self.budget.exhausted):
+                    self._checkpoint("done")
+
+        if self.cache_hits:
+            self.generation_metadata["cache_hits"] = dict(self.cache_hits)
+        if self.budget is not None:
+            self.generation_metadata["budget"] = self.budget.summary()
 
         return self.edited_story
 
+    def get_context(self, verbose=False):
+        """Sync wrapper around aget_context()."""
+        return _run_sync(self.aget_context(verbose=verbose))
+
+    def generate_story(self, verbose=False):
+        """Sync wrapper around agenerate_story()."""
+        return _run_sync(self.agenerate_story(verbose=verbose))
+
+    def edit_story(self, verbose=False):
+        """Sync wrapper around aedit_story()."""
+        return _run_sync(self.aedit_story(verbose=verbose))
+
+    def pipe(self, verbose=False):
+        """Sync wrapper around apipe(). Use `await apipe()` from inside an event loop."""
+        return _run_sync(self.apipe(verbose=verbose))
+
     def _check_state(self):
         errors = []
 
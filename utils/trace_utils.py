@@ -0,0 +1,241 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+# Upper bounds (seconds) of the latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# name -> (type, help) of every metric MetricsRegistry exports from spans.
+_METRICS = {
+    "prompt2prose_agent_calls_total": ("counter", "Agent calls by agent and outcome."),
+    "prompt2prose_agent_latency_seconds": ("histogram", "Latency of agent calls."),
+    "prompt2prose_agent_tokens_total": (
+        "counter",
+        "Prompt, completion and prompt-cached tokens by agent.",
+    ),
+    "prompt2prose_agent_cost_dollars_total": ("counter", "Simulated spend by agent."),
+    "prompt2prose_validator_verdicts_total": (
+        "counter",
+        "Validation check verdicts by validator and verdict.",
+    ),
+    "prompt2prose_validator_agreement_total": (
+        "counter",
+        "Verdicts of deciding validators (e.g. the local prefilter) against the verdict "
+        "of the check they defer to.",
+    ),
+    "prompt2prose_stage_total": ("counter", "Pipeline stages by stage and outcome."),
+    "prompt2prose_stage_latency_seconds": (
+        "histogram",
+        "Latency of pipeline stages (context, story, beat, attempt, edit, pipeline).",
+    ),
+}
+
+# Beat and attempt of the span being recorded, inherited by the spans nested in it.
+_span_attrs: ContextVar[Dict[str, Any]] = ContextVar("span_attrs", default={})
+
+
+class Span(BaseModel):
+    """
+    One timed agent call or pipeline stage.
+    Attributes:
+        name (str): Agent key (e.g. "prose") or stage name (e.g. "attempt").
+        kind (str): "agent" or "stage".
+        beat (int): Beat pair index, if the span belongs to one.
+        attempt (int): Candidate number within the beat, if any.
+        start (float): Seconds since the trace started.
+        duration (float): Seconds the span took.
+        outcome (str): "ok", "accepted"/"rejected" for checks and attempts, "error" or "cancelled".
+    """
+
+    name: str
+    kind: str = "stage"
+    beat: Optional[int] = None
+    attempt: Optional[int] = None
+    start: float = 0.0
+    duration: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_tokens: int = 0
+    cost: float = 0.0
+    outcome: Optional[str] = None
+    error: Optional[str] = None
+
+    def record_usage(self, usage: Dict[str, Any]) -> None:
+        """Copy tokens and cost from a track_usage() dict."""
+        self.prompt_tokens += usage["prompt_tokens"]
+        self.completion_tokens += usage["completion_tokens"]
+        self.cached_tokens += usage["cached_tokens"]
+        self.cost += usage["cost"]
+
+
+def agent_label(name: str) -> str:
+    """
+    Metric label of an agent key. Genre/style rewrite agents are keyed by their
+    client-supplied guide ("noir_genre", "noir+pirate_style"), so they share a fixed
+    label ("genre", "style", or "rewrite" for fused ones) to keep /metrics bounded.
+    """
+    if "+" in name and name.endswith("_style"):
+        return "rewrite"
+    if name.endswith(("_genre", "_style")):
+        return name.rsplit("_", 1)[-1]
+    return name
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...], **extra) -> str:
+    pairs = [*labels, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and latency histograms fed by finished spans,
+    rendered in the Prometheus text exposition format. Agent spans are labelled
+    by agent_label(); the full agent key stays on the span, in the run's trace.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        # (name, labels) -> [per-bucket counts, sum, count]
+        self._histograms: Dict[Tuple[str, tuple], list] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts, total, count = self._histograms.get(
+                key, [[0] * len(self.buckets), 0.0, 0]
+            )
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._histograms[key] = [counts, total + value, count + 1]
+
+    def observe_span(self, span: Span) -> None:
+        outcome = span.outcome or "ok"
+        if span.kind == "agent":
+            agent = agent_label(span.name)
+            self.inc("prompt2prose_agent_calls_total", agent=agent, outcome=outcome)
+            self.observe(
+                "prompt2prose_agent_latency_seconds", span.duration, agent=agent
+            )
+            for kind in ("prompt", "completion", "cached"):
+                tokens = getattr(span, f"{kind}_tokens")
+                if tokens:
+                    self.inc(
+                        "prompt2prose_agent_tokens_total",
+                        tokens,
+                        agent=agent,
+                        type=kind,
+                    )
+            if span.cost:
+                self.inc(
+                    "prompt2prose_agent_cost_dollars_total", span.cost, agent=agent
+                )
+        else:
+            self.inc("prompt2prose_stage_total", stage=span.name, outcome=outcome)
+            self.observe(
+                "prompt2prose_stage_latency_seconds", span.duration, stage=span.name
+            )
+
+    def render(self, gauges: Optional[Dict[str, float]] = None) -> str:
+        """
+        Prometheus text format of every metric, plus point-in-time gauges
+        (e.g. queue depth) passed in by the caller.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {
+                key: (list(counts), total, count)
+                for key, (counts, total, count) in self._histograms.items()
+            }
+
+        lines = []
+        for name, (kind, help_text) in _METRICS.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            if kind == "counter":
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(labels)} {value:g}")
+                continue
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(
+                        f"{name}_bucket{_labels(labels, le=f'{bound:g}')} {bucket_count}"
+                    )
+                lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {total:g}")
+                lines.append(f"{name}_count{_labels(labels)} {count}")
+
+        for name, value in (gauges or {}).items():
+            lines += [f"# TYPE {name} gauge", f"{name} {value:g}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+
+class Trace:
+    """
+    Spans of one BeatToStory run, in the order they finished.
+    Every finished span is also fed to a MetricsRegistry (the process-wide
+    `metrics` by default), so /metrics aggregates over all runs.
+    """
+
+    def __init__(self, registry: Optional[MetricsRegistry] = None):
+        self.registry = registry if registry is not None else metrics
+        self.spans: List[Span] = []
+        self._started = time.monotonic()
+
+    @contextmanager
+    def span(self, name: str, kind: str = "stage", **attrs) -> Iterator[Span]:
+        """
+        Time the block as a span. beat/attempt given here are inherited by the
+        spans opened inside the block, including in tasks it starts.
+        """
+        scope = {**_span_attrs.get(), **attrs}
+        token = _span_attrs.set(scope)
+        span = Span(
+            name=name,
+            kind=kind,
+            beat=scope.get("beat"),
+            attempt=scope.get("attempt"),
+            start=time.monotonic() - self._started,
+        )
+        started = time.perf_counter()
+        try:
+            yield span
+        except asyncio.CancelledError:
+            span.outcome = "cancelled"
+            raise
+        except Exception as e:
+            span.outcome = "error"
+            span.error = f"{e.__class__.__name__}: {e}"
+            raise
+        finally:
+            span.duration = time.perf_counter() - started
+            _span_attrs.reset(token)
+            self.spans.append(span)
+            self.registry.observe_span(span)
+
+    def dump(self) -> List[Dict[str, Any]]:
+        """The spans as JSON-able dicts, ordered by start time."""
+        return [span.model_dump() for span in sorted(self.spans, key=lambda s: s.start)]
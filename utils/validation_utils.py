@@ -0,0 +1,197 @@
+import math
+import random
+from typing import Any, Awaitable, Callable, Dict, List, Literal, Optional
+
+from pydantic import BaseModel
+
+from utils.trace_utils import metrics
+
+# Cheaper cost classes run first so free checks can reject before paid ones.
+COST_CLASS_ORDER = {"local": 0, "llm": 1}
+
+
+class Validator(BaseModel):
+    """
+    A pass/fail check on a candidate passage, backed by an agent in the pipeline.
+    Attributes:
+        name (str): Name used in rejection statistics.
+        agent (str): Key of the agent in BeatToStory.agents; it must return "True" to pass.
+        cost_class (str): "local" for free CPU checks, "llm" for checks that call a model.
+        stage (str): "pre" runs on the raw ProseAgent output, before genre/style transforms,
+            "post" runs on the transformed passage, "both" runs in each stage (the post run
+            is skipped when no transform changed the passage).
+        pass_beats (bool): If True the agent is called with (passage, [beat_a, beat_b]),
+            otherwise with (passage,) only.
+        pass_context (bool): If True the beat's scene context is passed after the beats.
+        decides (list): Names of later validators this one can settle. Its agent may then
+            also answer "Unsure": the passage passes on to those validators. A "True"
+            settles them as passed, so they are skipped for this attempt.
+        shadow_rate (float): Share of settling "True"/"False" verdicts deferred to the
+            decided validators anyway, to measure how often they agree.
+    """
+
+    name: str
+    agent: str
+    cost_class: Literal["local", "llm"] = "llm"
+    stage: Literal["pre", "post", "both"] = "post"
+    pass_beats: bool = False
+    pass_context: bool = False
+    decides: List[str] = []
+    shadow_rate: float = 0.0
+
+    def runs_in(self, stage: str) -> bool:
+        return self.stage in (stage, "both")
+
+
+def default_validators(prefilter_shadow_rate: float = 0.0) -> List[Validator]:
+    """
+    The StoryAgent and LengthAgent checks of the original pipeline, with the local
+    PrefilterAgent in front of StoryAgent. It runs before the genre/style transforms,
+    so clear failures are dropped before paying for them.
+    """
+    return [
+        Validator(name="length", agent="length", cost_class="local", stage="both"),
+        Validator(
+            name="prefilter",
+            agent="prefilter",
+            cost_class="local",
+            stage="pre",
+            pass_beats=True,
+            pass_context=True,
+            decides=["story"],
+            shadow_rate=prefilter_shadow_rate,
+        ),
+        Validator(name="story", agent="story", cost_class="llm", pass_beats=True),
+    ]
+
+
+class ValidationChain(BaseModel):
+    """
+    Runs validators cheapest first and stops at the first failure.
+    Keeps per-validator run/rejection counts for generation_metadata. Validators that
+    decide others also count accepts, deferrals and shadowed verdicts, plus how the
+    decided validators' verdicts compare with theirs: overall ("agreement", keyed
+    "own verdict->decided verdict") and by score band ("bands", keyed by score to 0.1).
+    """
+
+    validators: List[Validator] = []
+    stats: Dict[str, Dict[str, Any]] = {}
+
+    def ordered(self, stage: str, transformed: bool = True) -> List[Validator]:
+        return sorted(
+            (
+                v
+                for v in self.validators
+                if v.runs_in(stage) and (transformed or v.stage != "both")
+            ),
+            key=lambda v: COST_CLASS_ORDER[v.cost_class],
+        )
+
+    @staticmethod
+    def verdict_label(verdict: Any) -> str:
+        """
+        "True", "False" or "Unsure" for those exact verdicts, "other" for anything else.
+        LLM checks reply in free text, so raw replies would make unbounded stats keys
+        and metric series; "other" is rejected like "False".
+        """
+        verdict = str(verdict).strip()
+        return verdict if verdict in ("True", "False", "Unsure") else "other"
+
+    def _counts(self, name: str) -> Dict[str, Any]:
+        return self.stats.setdefault(name, {"runs": 0, "rejections": 0})
+
+    def _record_agreement(self, decider: str, verdict: Any, decided_verdict: str):
+        counts = self._counts(decider)
+        verdict_label = self.verdict_label(verdict)
+        key = f"{verdict_label}->{decided_verdict}"
+        agreement = counts.setdefault("agreement", {})
+        agreement[key] = agreement.get(key, 0) + 1
+
+        score = getattr(verdict, "score", None)
+        if score is not None:
+            band = f"{math.floor(score * 10) / 10:.1f}"
+            bands = counts.setdefault("bands", {}).setdefault(band, {})
+            bands[decided_verdict] = bands.get(decided_verdict, 0) + 1
+        metrics.inc(
+            "prompt2prose_validator_agreement_total",
+            validator=decider,
+            verdict=verdict_label,
+            decided_verdict=decided_verdict,
+        )
+
+    async def run(
+        self,
+        stage: str,
+        passage: str,
+        beats: List[str],
+        call_agent: Callable[..., Awaitable[Any]],
+        available: Optional[Dict[str, Any]] = None,
+        transformed: bool = True,
+        context: Any = None,
+        verdicts: Optional[Dict[str, Dict[str, Any]]] = None,
+    ) -> Optional[str]:
+        """
+        Run the validators of one stage against passage.
+        Arguments:
+        - stage: "pre" or "post".
+        - passage: The candidate passage.
+        - beats: [beat_a, beat_b] for validators that need them.
+        - call_agent: Coroutine function (agent_name, *args) that calls and bills an agent.
+        - available: Agents in the pipeline; validators whose agent is missing are skipped.
+        - transformed: False if the passage is unchanged since the "pre" stage.
+        - context: Scene context of the beat pair, for validators with pass_context.
+        - verdicts: Verdicts of deciding validators. Pass the same dict to the "pre" and
+          "post" runs of one attempt so a verdict from "pre" can settle a "post" validator.
+
+        Returns:
+        - None if every validator passed, otherwise the name of the one that rejected.
+        """
+        verdicts = {} if verdicts is None else verdicts
+        for validator in self.ordered(stage, transformed):
+            if available is not None and validator.agent not in available:
+                continue
+            deciders = [
+                (v.name, verdicts[v.name])
+                for v in self.validators
+                if validator.name in v.decides and v.name in verdicts
+            ]
+            if any(
+                d["settles"] and str(d["verdict"]).strip() == "True"
+                for _, d in deciders
+            ):
+                counts = self._counts(validator.name)
+                counts["settled"] = counts.get("settled", 0) + 1
+                continue
+
+            args = (passage, beats) if validator.pass_beats else (passage,)
+            if validator.pass_context:
+                args = (*args, context)
+            verdict = await call_agent(validator.agent, *args)
+            outcome = self.verdict_label(verdict)
+            metrics.inc(
+                "prompt2prose_validator_verdicts_total",
+                validator=validator.name,
+                verdict=outcome,
+            )
+            for decider, decided in deciders:
+                self._record_agreement(decider, decided["verdict"], outcome)
+
+            counts = self._counts(validator.name)
+            counts["runs"] += 1
+            if validator.decides:
+                settles = outcome in ("True", "False")
+                if settles and random.random() < validator.shadow_rate:
+                    settles = False
+                    counts["shadowed"] = counts.get("shadowed", 0) + 1
+                verdicts[validator.name] = {"verdict": verdict, "settles": settles}
+                if not settles:
+                    counts["deferred"] = counts.get("deferred", 0) + 1
+                    continue
+                if outcome == "True":
+                    counts["accepts"] = counts.get("accepts", 0) + 1
+                    continue
+            elif outcome == "True":
+                continue
+            counts["rejections"] += 1
+            return validator.name
+        return None